@@ -1,8 +1,20 @@
 import paho.mqtt.client as mqtt
-import json
+import socket
+import sys
 import time
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
+
+# Numba é opcional: sem ele os kernels rodam como Python/NumPy puro
+try:
+    from numba import njit, prange
+except ImportError:
+    prange = range
+    
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # ========================
 # CONFIGURAÇÃO
@@ -22,6 +34,22 @@ V_HEAD = 0.16
 T0_K = 273.15
 BASELINE_P = 1.00
 BASELINE_T = 39.0
+K_P0 = R_BARL * T0_K / V_HEAD  # Pressão a 0°C por mol de gás (bar/mol)
+
+# Template do payload JSON (esquema fixo) - evita json.dumps por mensagem
+TEMPLATE = (b'{"msg_id":"%s_f%d","assay_id":"' + ASSAY_ID.encode() + b'","flask_id":%d,'
+            b'"ts":"%s","P_bar_abs":%.2f,"T_C":%.1f,"P_bar_std":%.2f,'
+            b'"accum_bar_per_h":%.2f,"relief_count":%d,"event":%s}')
+EVENTO_JSON = {None: b'null', "relief": b'"relief"'}
+
+# Tópicos fixos por frasco (índice = frasco_id - 1)
+TOPICS = [f"rumen/{ASSAY_ID}/{f}/telemetry" for f in range(1, NUM_FRASCOS + 1)]
+
+# Linhas de feedback do loop em tempo real
+STATUS_OK = "🟢"
+STATUS_ALIVIO = "🔴"
+LINHA_TEMPO = "⏱️  Tempo VIRTUAL: %.1fh (%d/%d) | Tempo REAL: %.1fs"
+LINHA_FRASCO = "  %s Flask %d: P=%.2f bar, T=%.1f°C, Δ=%.2f bar/h"
 
 # ========================
 # FUNÇÕES
@@ -31,67 +59,113 @@ def gompertz(t, A, mu, lambda_):
     """Modelo de Gompertz para produção de gases"""
     return A * np.exp(-np.exp(mu * (lambda_ - t) / A))
 
-def calcular_pressao(t_h, frasco_id, seed=42):
-    """Calcula pressão e temperatura para um frasco em um tempo t"""
-    np.random.seed(seed + frasco_id + int(t_h * 10))
-    
-    # Volume de gás (Gompertz)
-    V_mL = gompertz(t_h, **PARAMS)
-    V_mL += np.random.normal(0, 0.05 * max(V_mL, 1))  # Ruído ±5%
+def make_gompertz(A, mu, lambda_):
+    """
+    Gera um Gompertz especializado com os parâmetros fixos embutidos
     
-    # Temperatura com variação
-    T_C = BASELINE_T + np.random.normal(0, 0.5)
-    T_K = T_C + T0_K
+    Os parâmetros viram constantes do kernel compilado (mu/A é dobrado
+    em tempo de compilação).
+    """
+    A = float(A)
+    k = mu / A
+    lambda_ = float(lambda_)
     
-    # Pressão absoluta
-    n = (V_mL / 1000.0) / 22.414  # mols
-    P_bar = (n * R_BARL * T_K) / V_HEAD
-    if P_bar < BASELINE_P:
-        P_bar = BASELINE_P
+    @njit(cache=True, fastmath=True)
+    def gompertz_fixo(t):
+        return A * np.exp(-np.exp(k * (lambda_ - t)))
     
-    # Correção térmica (normalização para 0°C)
-    P_corr = P_bar * (T0_K / T_K)
+    return gompertz_fixo
+
+# Gompertz do ensaio (PARAMS constantes)
+GOMPERTZ = make_gompertz(**PARAMS)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def compute_grid(t, threshold, z_V, z_T, out_P, out_P_pre, out_T, out_alivio):
+    """
+    Kernel fundido: Gompertz + ruído + lei dos gases + correção térmica + alívio
     
-    return P_corr, T_C, V_mL
+    Calcula cada célula [ponto, frasco] em uma única passada, escrevendo
+    direto nas matrizes de saída (sem arrays intermediários). out_P_pre guarda
+    a pressão antes do corte de alívio (base da acumulação por hora).
+    """
+    for i in prange(t.shape[0]):
+        # Volume de gás (Gompertz) é o mesmo para todos os frascos no ponto
+        V_base = GOMPERTZ(t[i])
+        escala = 0.05 * max(V_base, 1.0)
+        
+        for f in range(out_P.shape[1]):
+            V_mL = V_base + z_V[i, f] * escala  # Ruído ±5%
+            T_C = BASELINE_T + z_T[i, f] * 0.5
+            T_K = T_C + T0_K
+            
+            # Pressão absoluta já normalizada para 0°C: P_bar * T0_K/T_K = n * K
+            # (T_K se cancela); o piso BASELINE_P é aplicado antes da correção
+            n = (V_mL / 1000.0) / 22.414  # mols
+            P_corr = max(n * K_P0, BASELINE_P * T0_K / T_K)
+            out_P_pre[i, f] = P_corr
+            
+            # Alívio: reduz 10% acima do threshold
+            alivio = P_corr > threshold
+            if alivio:
+                P_corr *= 0.90
+            
+            out_P[i, f] = P_corr
+            out_T[i, f] = T_C
+            out_alivio[i, f] = alivio
 
-def criar_payload(frasco_id, t_h, P_prev, relief_counts, ts_base):
-    """Cria payload no formato esperado"""
-    P_corr, T_C, V_mL = calcular_pressao(t_h, frasco_id)
+def precalcular_telemetria(num_pontos, intervalo_h, seed=42):
+    """
+    Pré-calcula pressão, temperatura e eventos de alívio de todos os frascos
     
-    # Calcula acumulação por hora
-    if P_prev is not None:
-        acum_hora = (P_corr - P_prev) / 0.25  # Intervalo de 15min = 0.25h
-    else:
-        acum_hora = 0.00
+    Retorna matrizes [num_pontos+1, NUM_FRASCOS] (pressão publicada, pressão
+    antes do alívio, temperatura e alívio) para que o loop de
+    publicação em tempo real não faça nenhum cálculo numérico.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_pontos + 1) * intervalo_h
+    shape = (num_pontos + 1, NUM_FRASCOS)
     
-    # Verifica evento de alívio
-    evento = None
-    relief_count = relief_counts.get(frasco_id, 0)
+    # Ruído sorteado de uma vez (reprodutível pela seed)
+    z_V = rng.standard_normal(shape)
+    z_T = rng.standard_normal(shape)
     
-    if P_corr > THRESHOLD:
-        evento = "relief"
-        relief_count += 1
-        P_corr *= 0.90  # Reduz 10% após alívio
-        relief_counts[frasco_id] = relief_count
+    P_corr = np.empty(shape)
+    P_pre = np.empty(shape)
+    T_C = np.empty(shape)
+    alivio = np.empty(shape, dtype=np.bool_)
+    compute_grid(t, THRESHOLD, z_V, z_T, P_corr, P_pre, T_C, alivio)
     
-    # Timestamp simulado (baseado no tempo virtual, não real)
-    ts_virtual = ts_base + timedelta(hours=t_h)
-    ts_utc = ts_virtual.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return P_corr, P_pre, T_C, alivio
+
+def criar_payload(frasco_id, P_corr, T_C, acum_hora, relief_count, alivio, ts_utc):
+    """
+    Cria payload no formato esperado a partir dos valores pré-calculados
     
-    payload = {
-        "msg_id": f"msg_t{int(t_h):03d}_f{frasco_id}",
+    Os valores não são arredondados aqui: a precisão é aplicada pelo
+    TEMPLATE na serialização (%.2f / %.1f).
+    """
+    return {
         "assay_id": ASSAY_ID,
         "flask_id": frasco_id,
         "ts": ts_utc,
-        "P_bar_abs": round(P_corr, 2),
-        "T_C": round(T_C, 1),
-        "P_bar_std": round(P_corr, 2),
-        "accum_bar_per_h": round(acum_hora, 2),
+        "P_bar_abs": P_corr,
+        "T_C": T_C,
+        "P_bar_std": P_corr,
+        "accum_bar_per_h": acum_hora,
         "relief_count": relief_count,
-        "event": evento
+        "event": "relief" if alivio else None
     }
+
+def serializar_payload(payload, prefixo_tick):
+    """
+    Serializa o payload direto para bytes usando o TEMPLATE
     
-    return payload, P_corr
+    prefixo_tick: início do msg_id comum a todos os frascos do ponto (b"msg_tNNN")
+    """
+    return TEMPLATE % (prefixo_tick, payload["flask_id"], payload["flask_id"],
+                       payload["ts"].encode(), payload["P_bar_abs"], payload["T_C"],
+                       payload["P_bar_std"], payload["accum_bar_per_h"],
+                       payload["relief_count"], EVENTO_JSON[payload["event"]])
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -99,13 +173,14 @@ def on_connect(client, userdata, flags, rc):
     else:
         print(f"❌ Falha na conexão. Código: {rc}\n")
 
-def simular_fermentacao(duracao_h=48, intervalo_min=15, tempo_real_segundos=120):
+def simular_fermentacao(duracao_h=48, intervalo_min=15, tempo_real_segundos=120, qos=0):
     """
     Simula fermentação ruminal
     
     duracao_h: Duração VIRTUAL da simulação (padrão 48h)
     intervalo_min: Intervalo VIRTUAL entre leituras (padrão 15min)
     tempo_real_segundos: Tempo REAL que a simulação vai durar (ex: 120 = 2 minutos)
+    qos: QoS da telemetria de rotina (eventos de alívio sempre usam QoS 1)
     """
     client = mqtt.Client(client_id=f"RumenSim_{ASSAY_ID}")
     client.on_connect = on_connect
@@ -133,16 +208,27 @@ def simular_fermentacao(duracao_h=48, intervalo_min=15, tempo_real_segundos=120)
         print(f"   Delay entre publicações: {delay_real:.2f}s")
         print(f"   Threshold alívio: {THRESHOLD} bar\n")
         
+        # Pré-calcula toda a telemetria antes do loop em tempo real
+        P_corr, P_pre, T_C, alivio = precalcular_telemetria(num_pontos, intervalo_h)
+        
         # Conecta
         print("🔌 Conectando ao broker...")
         client.connect(BROKER, PORT, 60)
-        client.loop_start()
-        time.sleep(1)
+        # Desliga o algoritmo de Nagle para a rajada de cada ponto sair já
+        client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
-        # Estado inicial
-        P_prev = {i: None for i in range(1, NUM_FRASCOS + 1)}
-        relief_counts = {i: 0 for i in range(1, NUM_FRASCOS + 1)}
-        ts_base = datetime.utcnow()  # Timestamp base para simulação virtual
+        # Sem thread de rede: o loop MQTT é bombeado manualmente neste thread
+        limite = time.time() + 1
+        while not client.is_connected() and time.time() < limite:
+            client.loop(timeout=0.1)
+        
+        # Estado por ponto e frasco: acumulação por hora e contagem de alívios
+        acum_hora = np.zeros_like(P_corr)
+        # Leitura atual antes do alívio menos a pressão publicada no ponto anterior
+        acum_hora[1:] = (P_pre[1:] - P_corr[:-1]) / 0.25  # Intervalo de 15min = 0.25h
+        relief_counts = np.cumsum(alivio, axis=0, dtype=np.int32)
+        base_epoch = int(time.time())  # Timestamp base (UTC) para simulação virtual
+        pendentes = []  # Confirmações QoS>0 aguardadas só no final
         
         print("🚀 Iniciando simulação...\n")
         inicio_real = time.time()
@@ -151,43 +237,64 @@ def simular_fermentacao(duracao_h=48, intervalo_min=15, tempo_real_segundos=120)
             t_h = ponto * intervalo_h
             tempo_decorrido = time.time() - inicio_real
             
-            print(f"⏱️  Tempo VIRTUAL: {t_h:.1f}h ({ponto}/{num_pontos}) | "
-                  f"Tempo REAL: {tempo_decorrido:.1f}s")
+            # Timestamp simulado (tempo virtual), compartilhado pelos frascos
+            tm = time.gmtime(base_epoch + int(t_h * 3600))
+            ts_utc = "%04d-%02d-%02dT%02d:%02d:%02dZ" % (tm.tm_year, tm.tm_mon, tm.tm_mday,
+                                                          tm.tm_hour, tm.tm_min, tm.tm_sec)
+            linhas = [LINHA_TEMPO % (t_h, ponto, num_pontos, tempo_decorrido)]
             
-            # Publica dados de cada frasco
+            # Monta e serializa os payloads de todos os frascos do ponto
+            prefixo_tick = b'msg_t%03d' % int(t_h)
+            mensagens = []
             for frasco_id in range(1, NUM_FRASCOS + 1):
-                topic = f"rumen/{ASSAY_ID}/{frasco_id}/telemetry"
-                payload, P_atual = criar_payload(frasco_id, t_h, P_prev[frasco_id], 
-                                                 relief_counts, ts_base)
-                P_prev[frasco_id] = P_atual
-                
-                # Publica com QoS 1
-                result = client.publish(topic, json.dumps(payload), qos=1)
-                
-                # Feedback visual
-                if payload.get("event") == "relief":
-                    status = "🔴"
-                    relief_info = f" [ALÍVIO #{payload['relief_count']}]"
+                i = frasco_id - 1
+                topic = TOPICS[i]
+                payload = criar_payload(frasco_id, P_corr[ponto, i], T_C[ponto, i],
+                                        acum_hora[ponto, i], relief_counts[ponto, i],
+                                        alivio[ponto, i], ts_utc)
+                qos_msg = 1 if payload["event"] == "relief" else qos
+                mensagens.append((topic, serializar_payload(payload, prefixo_tick), qos_msg, payload))
+            
+            # Rajada de publicações: nenhum trabalho Python entre os publish,
+            # sem esperar PUBACK
+            for topic, dados, qos_msg, _ in mensagens:
+                info = client.publish(topic, dados, qos=qos_msg)
+                if qos_msg > 0:
+                    pendentes.append(info)
+            
+            # Feedback visual (uma única escrita no stdout por ponto)
+            for frasco_id, (_, _, _, payload) in enumerate(mensagens, start=1):
+                if payload["event"] == "relief":
+                    linhas.append(LINHA_FRASCO % (STATUS_ALIVIO, frasco_id, payload['P_bar_abs'],
+                                                  payload['T_C'], payload['accum_bar_per_h'])
+                                  + " [ALÍVIO #%d]" % payload['relief_count'])
                 else:
-                    status = "🟢"
-                    relief_info = ""
-                
-                print(f"  {status} Flask {frasco_id}: P={payload['P_bar_abs']:.2f} bar, "
-                      f"T={payload['T_C']:.1f}°C, Δ={payload['accum_bar_per_h']:.2f} bar/h{relief_info}")
+                    linhas.append(LINHA_FRASCO % (STATUS_OK, frasco_id, payload['P_bar_abs'],
+                                                  payload['T_C'], payload['accum_bar_per_h']))
+            
+            sys.stdout.write("\n".join(linhas) + "\n\n")
             
-            print()  # Linha em branco
+            # Envia o que restou no buffer e processa PUBACKs/keepalive
+            client.loop_write()
+            client.loop_read()
+            client.loop_misc()
             
             # Aguarda próximo intervalo (tempo real)
             if ponto < num_pontos:
                 time.sleep(delay_real)
         
+        # Aguarda confirmações pendentes (confirmação assíncrona)
+        limite = time.time() + 5
+        while any(not info.is_published() for info in pendentes) and time.time() < limite:
+            client.loop(timeout=0.1)
+        
         tempo_total = time.time() - inicio_real
         
         print("="*70)
         print("✅ Simulação concluída!")
         print(f"\n⏱️  Tempo REAL decorrido: {tempo_total:.1f}s ({tempo_total/60:.2f} min)")
         print(f"📊 Resumo de alívios:")
-        for frasco_id, count in relief_counts.items():
+        for frasco_id, count in enumerate(relief_counts[-1], start=1):
             print(f"   Flask {frasco_id}: {count} alívio(s)")
         print("="*70)
         
@@ -198,7 +305,6 @@ def simular_fermentacao(duracao_h=48, intervalo_min=15, tempo_real_segundos=120)
         import traceback
         traceback.print_exc()
     finally:
-        client.loop_stop()
         client.disconnect()
         print("\n👋 Desconectado do broker")
 
@@ -5,19 +5,81 @@ Baseado no sistema ANKOM RF para monitoramento de produção de gases
 
 import numpy as np
 import pandas as pd
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 import json
-from datetime import datetime, timedelta
+import itertools
+from datetime import datetime
 import uuid
 
+# Numba é opcional: sem ele os kernels rodam como Python/NumPy puro
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+def _gompertz_vec(t, A: float, mu_m: float, lam: float, e: float = np.e):
+    """
+    Avalia a curva Gompertz (sem ruído) para um escalar ou array de tempos
+
+    Args:
+        t: Tempo(s) em horas
+        A: Pressão assintótica (bar)
+        mu_m: Taxa máxima de produção (bar/h)
+        lam: Tempo de latência (h)
+        e: Constante de Euler
+
+    Returns:
+        Pressão(ões) em bar
+    """
+    return A * np.exp(-np.exp((mu_m * e / A) * (lam - t) + 1))
+
+@njit(cache=True)
+def _gompertz_pressure(A, mu_m, lam, t, baseline, noise):
+    """
+    Pressão absoluta de vários frascos no tempo t (kernel compilado)
+
+    Args:
+        A: Pressões assintóticas por frasco (bar)
+        mu_m: Taxas máximas por frasco (bar/h)
+        lam: Tempos de latência por frasco (h)
+        t: Tempo em horas (escalar, comum a todos os frascos)
+        baseline: Pressões baseline por frasco (bar)
+        noise: Ruído gaussiano a somar em cada frasco (bar)
+
+    Returns:
+        Array com a pressão de cada frasco, nunca abaixo do baseline
+    """
+    out = np.empty(A.shape[0])
+    for i in range(A.shape[0]):
+        if t < 0:
+            out[i] = baseline[i]
+        else:
+            p = A[i] * np.exp(-np.exp((mu_m[i] * np.e / A[i]) * (lam[i] - t) + 1)) + noise[i]
+            out[i] = max(baseline[i], p)
+    return out
+
+@njit(cache=True)
+def _normalize_pressure(P_meas, T_C):
+    """
+    Normaliza pressões para 0°C (versão compilada de GompertzModel.normalize_pressure)
+    """
+    return P_meas * (273.15 / (T_C + 273.15))
+
 class GompertzModel:
     """
     Modelo Gompertz para simulação da cinética de fermentação ruminal
     P(t) = A * exp(-exp((μm * e / A) * (λ - t) + 1))
     """
     
+    # Tamanho do bloco de ruído pré-sorteado usado por pressure_at_time
+    NOISE_POOL_SIZE = 4096
+    
     def __init__(self, A: float = 0.85, mu_m: float = 0.12, lam: float = 2.5, 
-                 baseline_pressure: float = 1.0, temperature: float = 39.0):
+                 baseline_pressure: float = 1.0, temperature: float = 39.0,
+                 seed: Optional[Union[int, np.random.Generator]] = None):
         """
         Inicializa o modelo Gompertz
         
@@ -27,6 +89,8 @@ class GompertzModel:
             lam: Tempo de latência (h)
             baseline_pressure: Pressão inicial (bar)
             temperature: Temperatura de operação (°C)
+            seed: Semente (reprodutibilidade) ou Generator já existente a
+                compartilhar; todo o ruído do modelo sai deste gerador
         """
         self.A = A  # Pressão assintótica
         self.mu_m = mu_m  # Taxa máxima
@@ -35,6 +99,12 @@ class GompertzModel:
         self.temperature = temperature  # Temperatura constante
         self.e = np.e  # Constante de Euler
         
+        # Gerador único do modelo; o ruído de pressure_at_time é sorteado em
+        # blocos (evita uma chamada ao RNG por ponto)
+        self._rng = np.random.default_rng(seed)
+        self._noise_pool = self._rng.normal(0, 0.01, self.NOISE_POOL_SIZE)
+        self._noise_idx = 0
+        
     def pressure_at_time(self, t: float) -> float:
         """
         Calcula a pressão absoluta no tempo t
@@ -49,12 +119,14 @@ class GompertzModel:
             return self.baseline_pressure
             
         # Modelo Gompertz
-        exponent = (self.mu_m * self.e / self.A) * (self.lam - t) + 1
-        pressure = self.A * np.exp(-np.exp(exponent))
+        pressure = _gompertz_vec(t, self.A, self.mu_m, self.lam, self.e)
         
-        # Adiciona ruído gaussiano controlado (CV < 5%)
-        noise = np.random.normal(0, 0.01)  # ~1% de ruído
-        pressure += noise
+        # Adiciona ruído gaussiano controlado (CV < 5%), ~1% de ruído
+        if self._noise_idx == self.NOISE_POOL_SIZE:
+            self._noise_pool = self._rng.normal(0, 0.01, self.NOISE_POOL_SIZE)
+            self._noise_idx = 0
+        pressure += self._noise_pool[self._noise_idx]
+        self._noise_idx += 1
         
         # Garante que não fique abaixo do baseline
         return max(self.baseline_pressure, pressure)
@@ -72,57 +144,65 @@ class GompertzModel:
         """
         return P_meas * (273.15 / (T_C + 273.15))
     
-    def generate_time_series(self, duration_hours: float = 48, 
-                           interval_minutes: int = 15) -> pd.DataFrame:
+    def generate_arrays(self, duration_hours: float = 48,
+                        interval_minutes: int = 15) -> Tuple[pd.DatetimeIndex, np.ndarray,
+                                                             np.ndarray, np.ndarray, np.ndarray]:
         """
-        Gera série temporal completa de dados de fermentação
+        Gera série temporal completa de dados de fermentação como arrays NumPy
         
         Args:
             duration_hours: Duração total da simulação (horas)
             interval_minutes: Intervalo entre medições (minutos)
             
         Returns:
-            DataFrame com dados de simulação
+            Tupla (timestamps, time_hours, P_bar_abs, T_C, P_bar_std)
         """
         # Gera timestamps
         start_time = datetime.now()
         total_points = int(duration_hours * 60 / interval_minutes)
+        timestamps = pd.date_range(start_time, periods=total_points,
+                                   freq=pd.Timedelta(minutes=interval_minutes))
+
+        # Tempo em horas de todos os pontos
+        t_hours = np.arange(total_points) * interval_minutes / 60.0
+
+        # Calcula pressão com modelo Gompertz (vetorizado) + ruído ~1%
+        pressures = _gompertz_vec(t_hours, self.A, self.mu_m, self.lam, self.e)
+        pressures += self._rng.normal(0, 0.01, total_points)
+        pressures = np.maximum(self.baseline_pressure, pressures)
+
+        # Temperatura constante com pequena variação (±0.2°C)
+        temperatures = self.temperature + self._rng.normal(0, 0.2, total_points)
+
+        # Normaliza pressão
+        normalized_pressures = self.normalize_pressure(pressures, temperatures)
+
+        return timestamps, t_hours, pressures, temperatures, normalized_pressures
+    
+    def generate_time_series(self, duration_hours: float = 48, 
+                           interval_minutes: int = 15) -> pd.DataFrame:
+        """
+        Gera série temporal completa de dados de fermentação
         
-        timestamps = []
-        pressures = []
-        temperatures = []
-        normalized_pressures = []
-        
-        for i in range(total_points):
-            # Calcula tempo em horas
-            t_hours = i * interval_minutes / 60.0
-            
-            # Gera timestamp
-            timestamp = start_time + timedelta(minutes=i * interval_minutes)
-            timestamps.append(timestamp)
-            
-            # Calcula pressão com modelo Gompertz
-            P_abs = self.pressure_at_time(t_hours)
-            pressures.append(P_abs)
-            
-            # Temperatura constante com pequena variação
-            temp_variation = np.random.normal(0, 0.2)  # ±0.2°C
-            temp = self.temperature + temp_variation
-            temperatures.append(temp)
+        Args:
+            duration_hours: Duração total da simulação (horas)
+            interval_minutes: Intervalo entre medições (minutos)
             
-            # Normaliza pressão
-            P_std = self.normalize_pressure(P_abs, temp)
-            normalized_pressures.append(P_std)
-        
-        # Cria DataFrame
+        Returns:
+            DataFrame com dados de simulação
+        """
+        timestamps, t_hours, pressures, temperatures, normalized_pressures = \
+            self.generate_arrays(duration_hours, interval_minutes)
+
+        # Cria DataFrame direto dos arrays NumPy (sem cópia)
         df = pd.DataFrame({
             'timestamp': timestamps,
-            'time_hours': [i * interval_minutes / 60.0 for i in range(total_points)],
+            'time_hours': t_hours,
             'P_bar_abs': pressures,
             'T_C': temperatures,
             'P_bar_std': normalized_pressures
-        })
-        
+        }, copy=False)
+
         return df
     
     def calculate_kinetic_parameters(self, df: pd.DataFrame) -> Dict:
@@ -135,22 +215,28 @@ class GompertzModel:
         Returns:
             Dicionário com parâmetros calculados
         """
+        P = df['P_bar_abs'].to_numpy()
+        t = df['time_hours'].to_numpy()
+        
         # Calcula taxa de acumulação (bar/h)
-        df['accum_bar_per_h'] = df['P_bar_abs'].diff() / df['time_hours'].diff()
+        accum = np.empty_like(P)
+        accum[0] = np.nan
+        accum[1:] = (P[1:] - P[:-1]) / (t[1:] - t[:-1])
+        df['accum_bar_per_h'] = accum
         
         # Encontra parâmetros do modelo
-        max_pressure = df['P_bar_abs'].max()
-        max_rate_idx = df['accum_bar_per_h'].idxmax()
-        max_rate_time = df.loc[max_rate_idx, 'time_hours']
+        max_pressure = P.max()
+        max_rate_idx = np.nanargmax(accum)
+        max_rate_time = t[max_rate_idx]
         
-        # Tempo de latência (interpolação)
+        # Tempo de latência (primeiro ponto acima do baseline)
         baseline = self.baseline_pressure
-        lat_idx = df[df['P_bar_abs'] > baseline + 0.05].index[0] if len(df[df['P_bar_abs'] > baseline + 0.05]) > 0 else 0
-        latency_time = df.loc[lat_idx, 'time_hours'] if lat_idx > 0 else 0
+        lat_idx = np.argmax(P > baseline + 0.05)
+        latency_time = t[lat_idx] if lat_idx > 0 else 0
         
         return {
             'A_observed': max_pressure - baseline,
-            'mu_max_observed': df['accum_bar_per_h'].max(),
+            'mu_max_observed': accum[max_rate_idx],
             'lambda_observed': latency_time,
             'R_squared': self._calculate_r_squared(df)
         }
@@ -165,9 +251,10 @@ class GompertzModel:
         Returns:
             Coeficiente R²
         """
-        # Gera valores preditos pelo modelo
+        # Gera valores preditos pelo modelo (curva teórica, sem ruído)
         t_values = df['time_hours'].values
-        predicted = [self.pressure_at_time(t) for t in t_values]
+        predicted = np.maximum(self.baseline_pressure,
+                               _gompertz_vec(t_values, self.A, self.mu_m, self.lam, self.e))
         observed = df['P_bar_abs'].values
         
         # Calcula R²
@@ -182,7 +269,13 @@ class MultiFlaskSimulator:
     Simulador multi-frasco para diferentes condições experimentais
     """
     
-    def __init__(self):
+    def __init__(self, seed: Optional[Union[int, np.random.Generator]] = None):
+        """
+        Args:
+            seed: Semente (reprodutibilidade) ou Generator já existente; o mesmo
+                gerador sorteia a variação entre réplicas e o ruído dos modelos
+        """
+        self._rng = np.random.default_rng(seed)
         self.scenarios = {
             'SAQ0505': {'A': 0.85, 'mu_m': 0.12, 'lam': 2.5},  # Alta produção
             'CONTROLE': {'A': 0.30, 'mu_m': 0.08, 'lam': 3.0},  # Controle baixo
@@ -208,14 +301,18 @@ class MultiFlaskSimulator:
         """
         results = []
         
+        # msg_id único na execução: prefixo aleatório + contador
+        run_id = uuid.uuid4().hex[:8]
+        msg_counter = itertools.count()
+        
         # Seleciona cenário base
         scenario_params = self.scenarios.get(assay_id, self.scenarios['SAQ0505'])
         
         for flask_id in range(1, num_flasks + 1):
             # Adiciona variação entre réplicas
-            A_var = scenario_params['A'] * np.random.normal(1, 0.05)
-            mu_m_var = scenario_params['mu_m'] * np.random.normal(1, 0.08)
-            lam_var = scenario_params['lam'] * np.random.normal(1, 0.10)
+            A_var = scenario_params['A'] * self._rng.normal(1, 0.05)
+            mu_m_var = scenario_params['mu_m'] * self._rng.normal(1, 0.08)
+            lam_var = scenario_params['lam'] * self._rng.normal(1, 0.10)
             
             # Cria modelo para este frasco
             model = GompertzModel(
@@ -223,31 +320,40 @@ class MultiFlaskSimulator:
                 mu_m=mu_m_var,
                 lam=lam_var,
                 baseline_pressure=1.0,
-                temperature=39.0
+                temperature=39.0,
+                seed=self._rng
             )
             
-            # Gera dados
-            df = model.generate_time_series(duration_hours, interval_minutes)
+            # Gera dados (arrays, sem DataFrame)
+            timestamps, t_hours, P_abs, T_C, P_std = model.generate_arrays(
+                duration_hours, interval_minutes)
+            
+            # Taxa de acumulação (bar/h), 0 no primeiro ponto
+            accum = np.zeros_like(P_abs)
+            accum[1:] = np.diff(P_abs) / np.diff(t_hours)
             
-            # Calcula parâmetros cinéticos
-            kinetic_params = model.calculate_kinetic_parameters(df)
+            # Colunas já arredondadas/formatadas como valores Python
+            ts_iso = timestamps.strftime('%Y-%m-%dT%H:%M:%S.%f').tolist()
+            event_mask = (P_abs >= 1.5).tolist()
+            columns = zip(ts_iso, np.round(P_abs, 3).tolist(), np.round(T_C, 1).tolist(),
+                          np.round(P_std, 3).tolist(), np.round(accum, 4).tolist(), event_mask)
             
             # Prepara dados para MQTT
-            for _, row in df.iterrows():
+            for ts, P, T, P_norm, rate, relief in columns:
                 payload = {
                     'schema_version': 1,
-                    'msg_id': str(uuid.uuid4()),
+                    'msg_id': f"{run_id}_{next(msg_counter):06d}",
                     'assay_id': assay_id,
                     'flask_id': flask_id,
-                    'timestamp': row['timestamp'].isoformat(),
-                    'P_bar_abs': round(row['P_bar_abs'], 3),
-                    'T_C': round(row['T_C'], 1),
-                    'P_bar_std': round(row['P_bar_std'], 3),
-                    'accum_bar_per_h': round(row.get('accum_bar_per_h', 0), 4) if not pd.isna(row.get('accum_bar_per_h', 0)) else 0
+                    'timestamp': ts,
+                    'P_bar_abs': P,
+                    'T_C': T,
+                    'P_bar_std': P_norm,
+                    'accum_bar_per_h': rate
                 }
                 
                 # Adiciona evento se houver alívio
-                if row['P_bar_abs'] >= 1.5:
+                if relief:
                     payload['event'] = 'relief'
                 
                 results.append(payload)
@@ -4,14 +4,83 @@ Publica dados de pressão e temperatura via MQTT
 """
 
 import paho.mqtt.client as mqtt
-import json
+import numpy as np
+import orjson
 import time
-import random
-from datetime import datetime
-from typing import Dict, List
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 import uuid
+import itertools
 import argparse
-from gompterz_model import MultiFlaskSimulator, GompertzModel
+import logging
+import logging.handlers
+import queue
+
+# MessagePack é opcional: só é necessário com --binary
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from gompterz_model import MultiFlaskSimulator, GompertzModel, _gompertz_pressure, _normalize_pressure
+
+logger = logging.getLogger(__name__)
+
+# Payload binário (--binary): chaves de um caractere e valores em ponto fixo
+#   v=schema_version, i=msg_id, n=assay_id, f=flask_id, ts=timestamp (ms epoch),
+#   p=P_bar_abs (mbar), t=T_C (0.1 °C), s=P_bar_std (mbar),
+#   a=accum_bar_per_h (mbar/h), e=event
+BINARY_TOPIC_SUFFIX = "telemetry.msgpack"
+
+def pack_telemetry(assay_id: str, flask_id: int, data: Dict) -> bytes:
+    """
+    Codifica um payload de telemetria em MessagePack compacto
+    
+    Args:
+        assay_id: Identificador do ensaio
+        flask_id: ID do frasco
+        data: Campos variáveis da medição (formato de generate_sensor_batch)
+        
+    Returns:
+        Bytes MessagePack com chaves curtas e valores inteiros
+    """
+    packed = {
+        'v': 1,
+        'i': data['msg_id'],
+        'n': assay_id,
+        'f': flask_id,
+        'ts': int(data['timestamp'].timestamp() * 1000),
+        'p': round(data['P_bar_abs'] * 1000),
+        't': round(data['T_C'] * 10),
+        's': round(data['P_bar_std'] * 1000),
+        'a': round(data['accum_bar_per_h'] * 1000)
+    }
+    if 'event' in data:
+        packed['e'] = data['event']
+    return msgpack.packb(packed, use_bin_type=True)
+
+def setup_logging(verbose: bool = False) -> logging.handlers.QueueListener:
+    """
+    Configura o logging através de uma fila: quem loga (inclusive o thread de
+    rede do paho) só enfileira o registro, e a escrita no console é feita por
+    um thread próprio
+    
+    Args:
+        verbose: Se True, inclui as mensagens de depuração (nível DEBUG)
+        
+    Returns:
+        QueueListener já iniciado (chamar stop() ao final)
+    """
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    listener = logging.handlers.QueueListener(log_queue, console)
+    listener.start()
+    return listener
 
 class ESP32Simulator:
     """
@@ -19,7 +88,8 @@ class ESP32Simulator:
     """
     
     def __init__(self, broker_host: str = "localhost", broker_port: int = 1883,
-                 assay_id: str = "SAQ0505", num_flasks: int = 4):
+                 assay_id: str = "SAQ0505", num_flasks: int = 4,
+                 telemetry_qos: int = 0, verbose: bool = False, binary: bool = False):
         """
         Inicializa o simulador ESP32
         
@@ -28,18 +98,45 @@ class ESP32Simulator:
             broker_port: Porta do broker MQTT
             assay_id: Identificador do ensaio
             num_flasks: Número de frascos
+            telemetry_qos: QoS da telemetria (alertas sempre usam QoS 1)
+            verbose: Conta as publicações confirmadas (callback on_publish)
+            binary: Publica a telemetria em MessagePack em .../telemetry.msgpack
         """
+        if binary and msgpack is None:
+            raise ImportError("--binary requer o pacote msgpack (pip install msgpack)")
+        
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.assay_id = assay_id
         self.num_flasks = num_flasks
+        self.telemetry_qos = telemetry_qos
+        self.binary = binary
+        
+        # msg_id = ensaio + prefixo aleatório da execução + contador
+        # (único entre execuções sem sortear um UUID por mensagem)
+        self._msg_prefix = f"{assay_id}-{uuid.uuid4().hex[:8]}-"
+        self._msg_seq = itertools.count()
+        
+        # Tópicos MQTT por frasco, formatados uma única vez
+        flask_ids = range(1, num_flasks + 1)
+        telemetry_suffix = BINARY_TOPIC_SUFFIX if binary else "telemetry"
+        self._telemetry_topics = {fid: f"rumen/{assay_id}/{fid}/{telemetry_suffix}" for fid in flask_ids}
+        self._alert_topics = {fid: f"rumen/{assay_id}/{fid}/alert" for fid in flask_ids}
+        self._config_topics = {fid: f"rumen/{assay_id}/{fid}/config" for fid in flask_ids}
         
         # Configura cliente MQTT
         self.client = mqtt.Client(client_id=f"esp32_simulator_{assay_id}")
         self.client.on_connect = self.on_connect
-        self.client.on_publish = self.on_publish
+        self._acked = 0  # Publicações confirmadas (contadas só em modo verbose)
+        if verbose:
+            self.client.on_publish = self.on_publish
         self.client.on_disconnect = self.on_disconnect
         
+        # Janela maior de mensagens QoS>0 sem ACK e fila de saída sem limite
+        # (o lote de cada medição sai inteiro, sem esperar PUBACKs)
+        self.client.max_inflight_messages_set(200)
+        self.client.max_queued_messages_set(0)
+        
         # Estado do sistema
         self.connected = False
         self.flask_states = {}
@@ -48,37 +145,79 @@ class ESP32Simulator:
         # Inicializa simulador
         self.simulator = MultiFlaskSimulator()
         
+        # Modelos Gompertz por frasco, criados uma única vez
+        self.models: Dict[int, GompertzModel] = {}
+        for flask_id in range(1, num_flasks + 1):
+            self.models[flask_id] = GompertzModel(
+                A=0.85 + (flask_id - 1) * 0.05,  # Variação entre frascos
+                mu_m=0.12 + (flask_id - 1) * 0.01,
+                lam=2.5 + (flask_id - 1) * 0.2,
+                baseline_pressure=1.0,
+                temperature=39.0
+            )
+            
+        # Parâmetros dos frascos em arrays (cálculo de todos os frascos de uma vez)
+        models = [self.models[flask_id] for flask_id in range(1, num_flasks + 1)]
+        self._A = np.array([m.A for m in models])
+        self._mu_m = np.array([m.mu_m for m in models])
+        self._lam = np.array([m.lam for m in models])
+        self._baseline = np.array([m.baseline_pressure for m in models])
+        self._temperature = np.array([m.temperature for m in models])
+        self._rng = np.random.default_rng()  # Gerador de ruído das medições
+        self._start_time = datetime.now()  # Início da fermentação (redefinido em run_simulation)
+        self._prev_P = None
+        self._prev_time = None
+        
+        # Campos fixos do JSON de cada frasco, já codificados: b'{"schema_version":1,...,"flask_id":N,'
+        self._prefix_bytes: Dict[int, bytes] = {
+            fid: orjson.dumps({'schema_version': 1, 'assay_id': assay_id, 'flask_id': fid})[:-1] + b','
+            for fid in range(1, num_flasks + 1)
+        }
+        
+        # Templates de payload por frasco com os campos variáveis (reaproveitados a cada medição)
+        self._payload_templates: Dict[int, Dict] = {
+            fid: {
+                'msg_id': None,
+                'timestamp': None,
+                'P_bar_abs': None,
+                'T_C': None,
+                'P_bar_std': None,
+                'accum_bar_per_h': None
+            }
+            for fid in range(1, num_flasks + 1)
+        }
+        self._payloads = list(self._payload_templates.values())
+        
     def on_connect(self, client, userdata, flags, rc):
         """Callback de conexão MQTT"""
         if rc == 0:
             self.connected = True
-            print(f"✅ Conectado ao broker MQTT: {self.broker_host}:{self.broker_port}")
+            logger.info(f"✅ Conectado ao broker MQTT: {self.broker_host}:{self.broker_port}")
             
             # Se inscreve em tópicos de configuração
-            for flask_id in range(1, self.num_flasks + 1):
-                config_topic = f"rumen/{self.assay_id}/{flask_id}/config"
+            for config_topic in self._config_topics.values():
                 self.client.subscribe(config_topic)
-                print(f"📡 Inscrito em: {config_topic}")
+                logger.debug("📡 Inscrito em: %s", config_topic)
         else:
-            print(f"❌ Erro de conexão MQTT: {rc}")
+            logger.error(f"❌ Erro de conexão MQTT: {rc}")
             
     def on_publish(self, client, userdata, mid):
-        """Callback de publicação MQTT"""
-        print(f"📤 Mensagem publicada (ID: {mid})")
+        """Callback de publicação MQTT (só conta; roda no thread de rede)"""
+        self._acked += 1
         
     def on_disconnect(self, client, userdata, rc):
         """Callback de desconexão MQTT"""
         self.connected = False
-        print("🔌 Desconectado do broker MQTT")
+        logger.info("🔌 Desconectado do broker MQTT")
         
     def on_message(self, client, userdata, message):
         """Callback de mensagem recebida"""
         try:
-            payload = json.loads(message.payload.decode())
+            payload = orjson.loads(message.payload)
             topic_parts = message.topic.split('/')
             flask_id = int(topic_parts[2])
             
-            print(f"⚙️  Configuração recebida para frasco {flask_id}: {payload}")
+            logger.info(f"⚙️  Configuração recebida para frasco {flask_id}: {payload}")
             
             # Atualiza configurações do frasco
             if flask_id not in self.flask_states:
@@ -91,99 +230,96 @@ class ESP32Simulator:
                 self.flask_states[flask_id]['relief_threshold'] = payload['relief_threshold']
                 
         except Exception as e:
-            print(f"❌ Erro ao processar mensagem: {e}")
+            logger.error(f"❌ Erro ao processar mensagem: {e}")
             
-    def generate_sensor_data(self, flask_id: int, current_time: datetime) -> Dict:
+    def generate_sensor_batch(self, current_time: datetime) -> List[Dict]:
         """
-        Gera dados simulados para um frasco
+        Gera dados simulados de todos os frascos em uma única passada vetorizada
         
         Args:
-            flask_id: ID do frasco
             current_time: Tempo atual
             
         Returns:
-            Dicionário com dados do sensor
+            Lista de dicionários com os campos variáveis de cada frasco (ordem de
+            flask_id); os campos fixos ficam em self._prefix_bytes. A lista e os
+            dicionários são os mesmos a cada chamada (atualizados no lugar):
+            serialize-os antes de gerar a próxima medição.
         """
-        # Cria modelo Gompertz para este frasco
-        base_A = 0.85 + (flask_id - 1) * 0.05  # Variação entre frascos
-        base_mu = 0.12 + (flask_id - 1) * 0.01
-        base_lambda = 2.5 + (flask_id - 1) * 0.2
-        
-        model = GompertzModel(
-            A=base_A,
-            mu_m=base_mu,
-            lam=base_lambda,
-            baseline_pressure=1.0,
-            temperature=39.0
-        )
+        # Calcula tempo decorrido desde o início da simulação
+        elapsed_hours = (current_time - self._start_time).total_seconds() / 3600
         
-        # Calcula tempo decorrido desde o início (simulado)
-        elapsed_hours = (current_time - datetime.now()).total_seconds() / 3600
-        
-        # Gera dados de sensores
-        P_abs = model.pressure_at_time(elapsed_hours)
-        T_C = 39.0 + random.normalvariate(0, 0.2)  # Temperatura com variação
-        P_std = model.normalize_pressure(P_abs, T_C)
+        # Gera dados de sensores (todos os frascos de uma vez)
+        P_abs = _gompertz_pressure(self._A, self._mu_m, self._lam, elapsed_hours,
+                                   self._baseline, self._rng.normal(0, 0.01, self.num_flasks))
+        T_C = self._rng.normal(self._temperature, 0.2)
+        P_std = _normalize_pressure(P_abs, T_C)
         
         # Calcula taxa de acumulação
-        if flask_id in self.flask_states and 'prev_pressure' in self.flask_states[flask_id]:
-            prev_P = self.flask_states[flask_id]['prev_pressure']
-            prev_time = self.flask_states[flask_id]['prev_time']
-            time_diff = (current_time - prev_time).total_seconds() / 3600  # horas
+        accum_rate = np.zeros(self.num_flasks)
+        if self._prev_P is not None:
+            time_diff = (current_time - self._prev_time).total_seconds() / 3600  # horas
             if time_diff > 0:
-                accum_rate = (P_abs - prev_P) / time_diff
-            else:
-                accum_rate = 0
-        else:
-            accum_rate = 0
-            
-        # Atualiza estado do frasco
-        if flask_id not in self.flask_states:
-            self.flask_states[flask_id] = {}
-            
-        self.flask_states[flask_id]['prev_pressure'] = P_abs
-        self.flask_states[flask_id]['prev_time'] = current_time
-        
-        # Prepara payload MQTT
-        payload = {
-            'schema_version': 1,
-            'msg_id': str(uuid.uuid4()),
-            'assay_id': self.assay_id,
-            'flask_id': flask_id,
-            'timestamp': current_time.isoformat(),
-            'P_bar_abs': round(P_abs, 3),
-            'T_C': round(T_C, 1),
-            'P_bar_std': round(P_std, 3),
-            'accum_bar_per_h': round(accum_rate, 4)
-        }
+                accum_rate = (P_abs - self._prev_P) / time_diff
+                
+        # Atualiza estado dos frascos
+        self._prev_P = P_abs
+        self._prev_time = current_time
         
-        # Verifica necessidade de alívio
-        relief_threshold = self.flask_states.get(flask_id, {}).get('relief_threshold', self.relief_threshold)
-        if P_abs >= relief_threshold:
-            payload['event'] = 'relief'
-            print(f"🚨 ALÍVIO ATIVADO - Frasco {flask_id}: {P_abs:.3f} bar")
+        # Preenche os payloads MQTT (templates reaproveitados a cada medição)
+        for flask_id, payload, P, T, P_n, accum in zip(self._payload_templates, self._payloads,
+                                                       P_abs.tolist(), T_C.tolist(),
+                                                       P_std.tolist(), accum_rate.tolist()):
+            payload['msg_id'] = f"{self._msg_prefix}{next(self._msg_seq):012d}"
+            payload['timestamp'] = current_time
+            payload['P_bar_abs'] = round(P, 3)
+            payload['T_C'] = round(T, 1)
+            payload['P_bar_std'] = round(P_n, 3)
+            payload['accum_bar_per_h'] = round(accum, 4)
             
-        return payload
+            # Verifica necessidade de alívio
+            relief_threshold = self.flask_states.get(flask_id, {}).get('relief_threshold', self.relief_threshold)
+            if P >= relief_threshold:
+                payload['event'] = 'relief'
+                logger.warning(f"🚨 ALÍVIO ATIVADO - Frasco {flask_id}: {P:.3f} bar")
+            else:
+                payload.pop('event', None)
+                
+        return self._payloads
     
-    def publish_telemetry(self, flask_id: int, data: Dict):
+    def publish_telemetry(self, batch: List[Tuple[int, Dict]]):
         """
-        Publica dados de telemetria
+        Publica dados de telemetria de vários frascos de uma vez
         
         Args:
-            flask_id: ID do frasco
-            data: Dados a publicar
+            batch: Lista de tuplas (flask_id, dados) a publicar, com os dados no
+                formato de generate_sensor_batch (apenas campos variáveis)
         """
-        topic = f"rumen/{self.assay_id}/{flask_id}/telemetry"
-        payload_json = json.dumps(data)
+        # Serializa tudo antes para que os publish() saiam em sequência
+        if self.binary:
+            messages = [(self._telemetry_topics[flask_id], pack_telemetry(self.assay_id, flask_id, data))
+                        for flask_id, data in batch]
+        else:
+            # Prefixo fixo pré-codificado + campos variáveis (sem o '{' inicial)
+            messages = [(self._telemetry_topics[flask_id],
+                         self._prefix_bytes[flask_id] + orjson.dumps(data)[1:])
+                        for flask_id, data in batch]
         
-        result = self.client.publish(topic, payload_json, qos=1)
+        results = [self.client.publish(topic, payload_json, qos=self.telemetry_qos)
+                   for topic, payload_json in messages]
         
-        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            print(f"📊 Publicado: {topic} - P: {data['P_bar_abs']} bar, T: {data['T_C']}°C")
-        else:
-            print(f"❌ Erro ao publicar: {topic}")
+        failed = [topic for (topic, _), result in zip(messages, results)
+                  if result.rc != mqtt.MQTT_ERR_SUCCESS]
+        for topic in failed:
+            logger.error(f"❌ Erro ao publicar: {topic}")
+            
+        # Resumo por ciclo só em DEBUG (--verbose); sem custo de formatação fora dele
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📊 Publicados %d/%d frascos: %s", len(messages) - len(failed), len(messages),
+                         ", ".join(f"F{flask_id} P={data['P_bar_abs']} bar T={data['T_C']}°C"
+                                   for flask_id, data in batch))
             
-    def publish_alert(self, flask_id: int, alert_type: str, message: str):
+    def publish_alert(self, flask_id: int, alert_type: str, message: str,
+                      timestamp: Optional[datetime] = None):
         """
         Publica alerta de segurança
         
@@ -191,22 +327,23 @@ class ESP32Simulator:
             flask_id: ID do frasco
             alert_type: Tipo de alerta
             message: Mensagem de alerta
+            timestamp: Instante da medição que gerou o alerta (padrão: agora)
         """
-        topic = f"rumen/{self.assay_id}/{flask_id}/alert"
+        topic = self._alert_topics[flask_id]
         
         alert_data = {
             'schema_version': 1,
-            'msg_id': str(uuid.uuid4()),
+            'msg_id': f"{self._msg_prefix}{next(self._msg_seq):012d}",
             'assay_id': self.assay_id,
             'flask_id': flask_id,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': timestamp or datetime.now(),
             'alert_type': alert_type,
             'message': message,
             'severity': 'high' if 'relief' in alert_type else 'medium'
         }
         
-        self.client.publish(topic, json.dumps(alert_data), qos=1)
-        print(f"🚨 Alerta publicado: {alert_type} - {message}")
+        self.client.publish(topic, orjson.dumps(alert_data), qos=1)
+        logger.warning(f"🚨 Alerta publicado: {alert_type} - {message}")
         
     def run_simulation(self, duration_hours: float = 48, interval_minutes: int = 15):
         """
@@ -216,8 +353,8 @@ class ESP32Simulator:
             duration_hours: Duração da simulação (horas)
             interval_minutes: Intervalo entre medições (minutos)
         """
-        print(f"🚀 Iniciando simulação: {self.assay_id}")
-        print(f"📊 Frascos: {self.num_flasks}, Duração: {duration_hours}h, Intervalo: {interval_minutes}min")
+        logger.info(f"🚀 Iniciando simulação: {self.assay_id}")
+        logger.info(f"📊 Frascos: {self.num_flasks}, Duração: {duration_hours}h, Intervalo: {interval_minutes}min")
         
         # Conecta ao broker MQTT
         try:
@@ -231,50 +368,55 @@ class ESP32Simulator:
                 timeout -= 1
                 
             if not self.connected:
-                print("❌ Timeout de conexão MQTT")
+                logger.error("❌ Timeout de conexão MQTT")
                 return
                 
         except Exception as e:
-            print(f"❌ Erro ao conectar ao broker MQTT: {e}")
+            logger.error(f"❌ Erro ao conectar ao broker MQTT: {e}")
             return
             
-        # Loop principal de simulação
-        start_time = datetime.now()
-        end_time = start_time + timedelta(hours=duration_hours)
+        # Loop principal de simulação (prazos em relógio monotônico, sem deriva)
+        interval_s = interval_minutes * 60
+        t0 = time.monotonic()
+        t_end = t0 + duration_hours * 3600
         
         measurement_count = 0
         
+        self._start_time = datetime.now()
+        
         try:
-            while datetime.now() < end_time:
-                current_time = datetime.now()
+            while time.monotonic() < t_end:
+                # Gera e publica em lote a medição deste instante (os payloads são
+                # reaproveitados no lugar, então a geração não pode sobrepor o envio)
+                batch = list(zip(self._payload_templates, self.generate_sensor_batch(
+                    self._start_time + timedelta(seconds=measurement_count * interval_s))))
+                self.publish_telemetry(batch)
                 
-                # Publica dados para cada frasco
-                for flask_id in range(1, self.num_flasks + 1):
-                    sensor_data = self.generate_sensor_data(flask_id, current_time)
-                    self.publish_telemetry(flask_id, sensor_data)
-                    
-                    # Verifica alertas
+                # Verifica alertas
+                for flask_id, sensor_data in batch:
                     if sensor_data.get('event') == 'relief':
                         self.publish_alert(
                             flask_id, 
                             'pressure_relief',
-                            f"Válvula de alívio ativada: {sensor_data['P_bar_abs']:.3f} bar"
+                            f"Válvula de alívio ativada: {sensor_data['P_bar_abs']:.3f} bar",
+                            sensor_data['timestamp']
                         )
                         
                 measurement_count += 1
+                logger.debug("📤 Mensagens confirmadas até agora: %s", self._acked)
                 
-                # Aguarda próximo intervalo
-                time.sleep(interval_minutes * 60)
+                # Aguarda próximo intervalo (compensa o tempo gasto publicando)
+                time.sleep(max(0.0, t0 + measurement_count * interval_s - time.monotonic()))
                 
         except KeyboardInterrupt:
-            print("\n⏹️  Simulação interrompida pelo usuário")
+            logger.info("⏹️  Simulação interrompida pelo usuário")
             
         finally:
             # Desconecta
             self.client.loop_stop()
             self.client.disconnect()
             
-            print(f"✅ Simulação finalizada. Total de medições: {measurement_count}")
+            logger.info(f"✅ Simulação finalizada. Total de medições: {measurement_count}")
 
 def main():
     """
@@ -287,21 +429,32 @@ def main():
     parser.add_argument('--flasks', type=int, default=4, help='Número de frascos')
     parser.add_argument('--duration', type=float, default=48, help='Duração em horas')
     parser.add_argument('--interval', type=int, default=15, help='Intervalo em minutos')
+    parser.add_argument('--qos', type=int, default=0, choices=[0, 1, 2], help='QoS da telemetria')
+    parser.add_argument('--verbose', action='store_true', help='Log detalhado (inclui cada publicação)')
+    parser.add_argument('--binary', action='store_true',
+                        help='Telemetria em MessagePack compacto (tópico .../telemetry.msgpack)')
     
     args = parser.parse_args()
+    listener = setup_logging(args.verbose)
     
     # Cria e executa simulador
     simulator = ESP32Simulator(
         broker_host=args.broker,
         broker_port=args.port,
         assay_id=args.assay,
-        num_flasks=args.flasks
+        num_flasks=args.flasks,
+        telemetry_qos=args.qos,
+        verbose=args.verbose,
+        binary=args.binary
     )
     
-    simulator.run_simulation(
-        duration_hours=args.duration,
-        interval_minutes=args.interval
-    )
+    try:
+        simulator.run_simulation(
+            duration_hours=args.duration,
+            interval_minutes=args.interval
+        )
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import json
 import time
 import uuid
+from contextlib import contextmanager
 from datetime import datetime
 
 import paho.mqtt.client as mqtt
@@ -9,11 +10,38 @@ BROKER = 'localhost'
 PORT = 1883
 ASSAY = 'ensaio_001'
 
-client = mqtt.Client(client_id=f'publisher_once_{ASSAY}')
-client.connect(BROKER, PORT, 60)
-client.loop_start()
 
-def publish(flask_id, p, t):
+class MqttSession:
+    """Conexão MQTT aberta uma vez e reutilizada para vários envios"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def publish(self, topic, payload, qos=0):
+        return self.client.publish(topic, payload, qos=qos)
+
+    def publish_all(self, messages, qos=0, timeout=2.0):
+        """Publica todas as mensagens e espera a confirmação de cada uma (até timeout s no total)"""
+        infos = [self.publish(topic, payload, qos) for topic, payload in messages]
+        deadline = time.monotonic() + timeout
+        for info in infos:
+            info.wait_for_publish(timeout=max(0.0, deadline - time.monotonic()))
+        return infos
+
+
+@contextmanager
+def mqtt_session(broker=BROKER, port=PORT):
+    client = mqtt.Client(client_id=f'publisher_once_{ASSAY}')
+    client.connect(broker, port, 60)
+    client.loop_start()
+    try:
+        yield MqttSession(client)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+def telemetry_message(flask_id, p, t):
     now = datetime.utcnow().isoformat() + 'Z'
     payload = {
         'schema_version': 1,
@@ -26,16 +54,21 @@ def publish(flask_id, p, t):
         'T_C': t
     }
     topic = f'rumen/{ASSAY}/{flask_id}/telemetry'
-    client.publish(topic, json.dumps(payload), qos=1)
-    print(f'Published to {topic}: {payload}')
-
-# Valores dentro dos ranges válidos
-publish(3, 1.18, 38.1)
-publish(3, 1.24, 38.6)
-publish(4, 1.12, 37.4)
-publish(4, 1.28, 36.9)
-
-# Aguarda envio
-time.sleep(2)
-client.loop_stop()
-client.disconnect
\ No newline at end of file
+    return topic, json.dumps(payload)
+
+
+if __name__ == '__main__':
+    # Valores dentro dos ranges válidos
+    messages = [
+        telemetry_message(3, 1.18, 38.1),
+        telemetry_message(3, 1.24, 38.6),
+        telemetry_message(4, 1.12, 37.4),
+        telemetry_message(4, 1.28, 36.9),
+    ]
+
+    # Aguarda envio (sai assim que todas as mensagens forem confirmadas)
+    with mqtt_session(BROKER, PORT) as session:
+        session.publish_all(messages)
+
+    for topic, payload in messages:
+        print(f'Published to {topic}: {payload}')
@@ -1,18 +1,33 @@
 # Simulador ANKOM RF - Modelo de Fermentação Ruminal
 # Baseado no modelo Gompertz para simulação de produção de gases
 
-import json
+import orjson
 import time
 import random
 import uuid
-from datetime import datetime, timedelta
+import itertools
+from datetime import datetime, timedelta, timezone
 import paho.mqtt.client as mqtt
 import numpy as np
 from scipy.optimize import curve_fit
 import threading
+import heapq
 import argparse
 import logging
 
+# Numba é opcional: sem ele o kernel do ciclo roda como Python puro
+try:
+    from numba import njit, prange
+except ImportError:
+    prange = range
+    
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+R_GAS = 0.08314  # Constante dos gases (L·bar/mol·K)
+
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -46,6 +61,57 @@ class GompertzModel:
         pure_value = self.gompertz(t)
         noise = np.random.normal(0, noise_level * pure_value)
         return max(0.5, pure_value + noise)  # Limitar valor mínimo
+    
+    def fit(self, t, pressure):
+        """
+        Ajustar A, B, C a pressões medidas (baseline fixo), com Jacobiano analítico
+        """
+        t = np.asarray(t, dtype=float)
+        y = np.asarray(pressure, dtype=float) - self.baseline
+        (self.A, self.B, self.C), _ = curve_fit(gompertz_curve, t, y, p0=(self.A, self.B, self.C),
+                                                jac=gompertz_jac, method='lm')
+        return self.A, self.B, self.C
+
+def gompertz_curve(t, A, B, C):
+    """
+    Gompertz sem baseline: A * exp(-exp(B * (C - t)))
+    """
+    return A * np.exp(-np.exp(B * (C - t)))
+
+def gompertz_jac(t, A, B, C):
+    """
+    Jacobiano analítico de gompertz_curve em relação a (A, B, C)
+    """
+    e1 = np.exp(B * (C - t))
+    e2 = np.exp(-e1)
+    dA = e2
+    dB = A * e2 * e1 * (t - C)
+    dC = -A * e2 * e1 * B
+    return np.stack([dA, dB, dC], axis=1)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def tick_kernel(A, B, C, baseline, t, noise_p, noise_T, temp, relief_thr, relief_p, relief_count,
+                out_p, out_p_raw, out_T, out_relief, out_inv_Tk):
+    """
+    Kernel de um ciclo para todos os frascos: Gompertz + ruído (pressão),
+    variação limitada a 38-40°C (temperatura) e alívio acima de relief_thr
+    (pressão reduzida para relief_p, relief_count incrementado); out_p_raw
+    recebe a pressão medida antes do alívio e out_inv_Tk o fator de
+    normalização térmica 273.15 / (T + 273.15)
+    """
+    for i in prange(A.size):
+        p = baseline[i] + A[i] * np.exp(-np.exp(B[i] * (C[i] - t[i])))
+        p += noise_p[i] * 0.01 * p
+        p = max(0.5, p)  # Limitar valor mínimo
+        out_p_raw[i] = p
+        out_relief[i] = p > relief_thr[i]
+        if out_relief[i]:
+            p = relief_p[i]
+            relief_count[i] += 1
+        out_p[i] = p
+        T = min(40.0, max(38.0, temp[i] + noise_T[i] * 0.5))
+        out_T[i] = T
+        out_inv_Tk[i] = 273.15 / (T + 273.15)
 
 class ANKOMSimulator:
     """
@@ -53,12 +119,45 @@ class ANKOMSimulator:
     """
     def __init__(self, config):
         self.config = config
+        
+        # Escalares da configuração usados a cada ciclo, lidos uma única vez
+        self._relief_thr = config['relief_threshold']
+        self._safe_relief = self._relief_thr - 0.1  # Pressão após o alívio
+        self._sample_dt_s = config['sampling_interval'] * 60  # Intervalo de amostragem (s)
+        self._sample_dt_h = config['sampling_interval'] / 60.0  # Intervalo de amostragem (h)
+        self._log_every = max(1, config.get('log_interval', 1))  # Logar a publicação a cada N ciclos
+        self._tick_counter = 0
         self.flasks = {}
         self.mqtt_client = None
         self.running = False
-        self.threads = []
         self.time_warp = 1.0  # Fator de aceleração de tempo
-        self.paused = False
+        self.rng = np.random.default_rng()  # Gerador de ruído (PCG64)
+        
+        # msg_id = UUID da sessão + contador (um único UUID por execução)
+        self.session = uuid.uuid4().hex
+        self.msg_counter = itertools.count()
+        
+        # Pausa/retomada: setado = rodando, limpo = pausado (o laço bloqueia no wait)
+        self._run_event = threading.Event()
+        self._run_event.set()
+        
+        # Ações agendadas: heap de (prazo em time.monotonic(), flask_id, ação)
+        self._scheduled = []
+        self._scheduled_lock = threading.Lock()
+        
+        # Tabelas de despacho dos comandos MQTT (sufixo do tópico -> handler)
+        self._control_dispatch = {
+            "ankom/control/speed": self._h_speed,
+            "ankom/control/pause": self._h_pause,
+            "ankom/control/resume": self._h_resume,
+        }
+        self._rumen_dispatch = {
+            "control/start-with-delay": self._h_start_delay,
+            "control/stop-with-limit": self._h_stop_limit,
+            "control/emergency-shutdown": self._h_emergency,
+            "relief-config": self._h_relief_config,
+            "initial-config": self._h_initial_config,
+        }
         
         # Inicializar frascos
         self.initialize_flasks()
@@ -87,16 +186,61 @@ class ANKOMSimulator:
             
             self.flasks[flask_id] = {
                 'assay_id': assay_id,
+                'topic': f"ankom/{assay_id}/flask{flask_id}/telemetry",
+                # Campos fixos do payload já codificados: '{"schema_version":1,...,"flask_id":N,'
+                'payload_prefix': orjson.dumps({"schema_version": 1, "assay_id": assay_id,
+                                                "flask_id": flask_id})[:-1] + b',',
                 'model': GompertzModel(**gompertz_params),
                 'start_time': datetime.now(),
+                'start_monotonic': time.monotonic(),
                 'sim_hours': 0.0,
                 'last_relief': datetime.now(),
-                'relief_count': 0,
                 'temperature': 39.0,  # Temperatura base 39°C
                 'baseline_pressure': 1.0  # Pressão inicial 1.0 bar
             }
             
             logger.info(f"Frasco {flask_id} inicializado: A={gompertz_params['A']}, B={gompertz_params['B']}, C={gompertz_params['C']}")
+        
+        # Estado numérico dos frascos em Struct-of-Arrays (índice = flask_id - 1)
+        # float32 para parâmetros e pressões; float64 só para instantes de time.monotonic()
+        flasks = list(self.flasks.values())
+        f4 = np.float32
+        self.flask_arr = {
+            'A': np.array([f['model'].A for f in flasks], dtype=f4),
+            'B': np.array([f['model'].B for f in flasks], dtype=f4),
+            'C': np.array([f['model'].C for f in flasks], dtype=f4),
+            'baseline': np.array([f['model'].baseline for f in flasks], dtype=f4),
+            'temperature': np.array([f['temperature'] for f in flasks], dtype=f4),
+            'relief_count': np.zeros(len(flasks), dtype=np.int32),
+            'relief_threshold': np.full(len(flasks), self._relief_thr, dtype=f4),
+            'relief_pressure': np.full(len(flasks), self._safe_relief, dtype=f4),
+            'sim_hours': np.zeros(len(flasks)),
+            'start_monotonic': np.array([f['start_monotonic'] for f in flasks]),
+            'last_pressure': np.array([f['model'].baseline for f in flasks], dtype=f4),
+            'last_time_s': np.full(len(flasks), np.nan),  # Sem leitura anterior
+            'warning_threshold': np.full(len(flasks), 4.5, dtype=f4),
+            'solenoid_open': np.zeros(len(flasks), dtype=np.bool_),
+            'emergency_mode': np.zeros(len(flasks), dtype=np.bool_),
+            'permanent_purge': np.zeros(len(flasks), dtype=np.bool_)
+        }
+        self._rebuild_assay_index()
+        
+        # Saídas do kernel do ciclo, pré-alocadas
+        self._pressure = np.empty(len(flasks), dtype=f4)
+        self._pressure_raw = np.empty(len(flasks), dtype=f4)  # Pressão medida, antes do alívio
+        self._temperature = np.empty(len(flasks), dtype=f4)
+        self._relief = np.empty(len(flasks), dtype=np.bool_)
+        self.inv_Tk_norm = np.empty(len(flasks), dtype=f4)  # 273.15 / (T + 273.15) do último ciclo
+    
+    def _rebuild_assay_index(self):
+        """
+        Reconstruir o índice assay_id -> índices dos frascos (chamar ao mudar assay_id)
+        """
+        by_assay = {}
+        for flask_id, flask in self.flasks.items():
+            by_assay.setdefault(flask['assay_id'], []).append(flask_id - 1)
+        self._flasks_by_assay = {assay_id: np.array(idx, dtype=np.intp) for assay_id, idx in by_assay.items()}
+        self._no_flasks = np.empty(0, dtype=np.intp)
     
     def setup_mqtt(self):
         """
@@ -137,83 +281,98 @@ class ANKOMSimulator:
 
     def on_message(self, client, userdata, message):
         try:
-            payload = json.loads(message.payload.decode())
+            payload = orjson.loads(message.payload)
             topic = message.topic
             
-            # Comandos de controle de tempo existentes
-            if topic.startswith("ankom/control/speed"):
-                speed = float(payload.get('speed', 1.0))
-                self.time_warp = max(1.0, speed)
-                logger.info(f"⚡ Acelerando simulação: {self.time_warp}x")
-            elif topic.startswith("ankom/control/pause"):
-                self.paused = True
-                logger.info("⏸️ Simulação pausada")
-            elif topic.startswith("ankom/control/resume"):
-                self.paused = False
-                logger.info("▶️ Simulação retomada")
-            
             # Novos comandos RR Rural Fermentation
-            elif topic.startswith("rumen/"):
+            if topic.startswith("rumen/"):
                 self.handle_rumen_control(topic, payload)
+                return
+            
+            # Comandos de controle de tempo existentes (ankom/control/<comando>)
+            handler = self._control_dispatch.get("/".join(topic.split('/', 3)[:3]))
+            if handler:
+                handler(payload)
                 
         except Exception as e:
             logger.error(f"Erro ao processar controle MQTT: {e}")
     
+    def _h_speed(self, payload):
+        speed = float(payload.get('speed', 1.0))
+        self.time_warp = max(1.0, speed)
+        logger.info(f"⚡ Acelerando simulação: {self.time_warp}x")
+    
+    def _h_pause(self, payload):
+        self._run_event.clear()
+        logger.info("⏸️ Simulação pausada")
+    
+    def _h_resume(self, payload):
+        self._run_event.set()
+        logger.info("▶️ Simulação retomada")
+    
     def handle_rumen_control(self, topic, payload):
         """
         Processar comandos específicos do RR Rural Fermentation
         """
         try:
-            # START com delay e equalização
-            if topic.endswith("/control/start-with-delay"):
-                delay_seconds = payload.get('delay_seconds', 10)
-                self.handle_start_with_delay(payload['assay_id'], delay_seconds)
-            
-            # STOP individual com limite de tempo
-            elif topic.endswith("/control/stop-with-limit"):
-                self.handle_stop_with_limit(
-                    payload['assay_id'], 
-                    payload['flask_id'], 
-                    payload['duration_hours']
-                )
-            
-            # EMERGENCY SHUTDOWN
-            elif topic.endswith("/control/emergency-shutdown"):
-                self.handle_emergency_shutdown(payload['assay_id'])
-            
-            # Configuração de alívio de pressão
-            elif topic.endswith("/relief-config"):
-                self.handle_relief_config(payload['assay_id'], payload)
-            
-            # Configuração inicial de vasos
-            elif topic.endswith("/initial-config"):
-                self.handle_flask_initial_config(payload)
+            # Sufixo de um nível (relief-config) ou de dois níveis (control/stop-with-limit)
+            parts = topic.rsplit('/', 2)
+            handler = self._rumen_dispatch.get(parts[-1])
+            if handler is None and len(parts) > 1:
+                handler = self._rumen_dispatch.get(f"{parts[-2]}/{parts[-1]}")
+            if handler:
+                handler(payload)
                 
         except Exception as e:
             logger.error(f"Erro ao processar comando rumen: {e}")
     
+    # START com delay e equalização
+    def _h_start_delay(self, payload):
+        delay_seconds = payload.get('delay_seconds', 10)
+        self.handle_start_with_delay(payload['assay_id'], delay_seconds)
+    
+    # STOP individual com limite de tempo
+    def _h_stop_limit(self, payload):
+        self.handle_stop_with_limit(
+            payload['assay_id'], 
+            payload['flask_id'], 
+            payload['duration_hours']
+        )
+    
+    # EMERGENCY SHUTDOWN
+    def _h_emergency(self, payload):
+        self.handle_emergency_shutdown(payload['assay_id'])
+    
+    # Configuração de alívio de pressão
+    def _h_relief_config(self, payload):
+        self.handle_relief_config(payload['assay_id'], payload)
+    
+    # Configuração inicial de vasos
+    def _h_initial_config(self, payload):
+        self.handle_flask_initial_config(payload)
+    
     def handle_start_with_delay(self, assay_id, delay_seconds):
         """
         START com delay para equalização de pressão
         """
         logger.info(f"🔄 Iniciando ensaio {assay_id} com delay de {delay_seconds}s")
         
+        idx = self._flasks_by_assay.get(assay_id, self._no_flasks)
+        
         # Abrir solenoides para equalização
-        for flask_id in self.flasks:
-            if self.flasks[flask_id]['assay_id'] == assay_id:
-                logger.info(f"  📭 Abrindo solenoide do frasco {flask_id} para equalização")
-                # Simular abertura de solenoide
-                self.flasks[flask_id]['solenoid_open'] = True
+        for i in idx.tolist():
+            logger.info(f"  📭 Abrindo solenoide do frasco {i + 1} para equalização")
+        # Simular abertura de solenoide
+        self.flask_arr['solenoid_open'][idx] = True
         
         # Aguardar delay
         time.sleep(delay_seconds)
         
         # Fechar solenoides e iniciar medição
-        for flask_id in self.flasks:
-            if self.flasks[flask_id]['assay_id'] == assay_id:
-                logger.info(f"  🔒 Fechando solenoide do frasco {flask_id}, pressão ajustada para 1.0 bar")
-                self.flasks[flask_id]['solenoid_open'] = False
-                self.flasks[flask_id]['baseline_pressure'] = 1.0
+        for i in idx.tolist():
+            logger.info(f"  🔒 Fechando solenoide do frasco {i + 1}, pressão ajustada para 1.0 bar")
+            self.flasks[i + 1]['baseline_pressure'] = 1.0
+        self.flask_arr['solenoid_open'][idx] = False
         
         logger.info(f"✅ Ensaio {assay_id} iniciado com sucesso após equalização")
     
@@ -223,19 +382,25 @@ class ANKOMSimulator:
         """
         logger.info(f"⏹️ Configurando parada do frasco {flask_id} do ensaio {assay_id} em {duration_hours}h")
         
-        # Agendar parada futura (em produção, usar sistema de agendamento real)
-        def scheduled_stop():
-            end_time = datetime.now() + timedelta(hours=duration_hours)
-            logger.info(f"  ⏰ Parada agendada para {end_time}")
+        # Agendar parada futura: entrada no heap processada pelo laço de simulação
+        end_time = datetime.now() + timedelta(hours=duration_hours)
+        logger.info(f"  ⏰ Parada agendada para {end_time}")
+        with self._scheduled_lock:
+            heapq.heappush(self._scheduled, (time.monotonic() + duration_hours * 3600, flask_id, 'purge'))
+    
+    def run_scheduled(self, now):
+        """
+        Executar as ações agendadas cujo prazo (time.monotonic()) já passou
+        """
+        while self._scheduled and self._scheduled[0][0] <= now:
+            with self._scheduled_lock:
+                _, flask_id, action = heapq.heappop(self._scheduled)
             
             # Quando chegar a hora, abrir solenoide permanentemente
-            if flask_id in self.flasks:
+            if action == 'purge' and flask_id in self.flasks:
                 logger.info(f"  📭 Abrindo solenoide do frasco {flask_id} permanentemente para purga")
-                self.flasks[flask_id]['solenoid_open'] = True
-                self.flasks[flask_id]['permanent_purge'] = True
-        
-        # Iniciar thread para agendamento (simulação)
-        threading.Thread(target=lambda: (time.sleep(duration_hours * 3600), scheduled_stop())).start()
+                self.flask_arr['solenoid_open'][flask_id - 1] = True
+                self.flask_arr['permanent_purge'][flask_id - 1] = True
     
     def handle_emergency_shutdown(self, assay_id):
         """
@@ -243,11 +408,11 @@ class ANKOMSimulator:
         """
         logger.error(f"🚨 EMERGENCY SHUTDOWN para ensaio {assay_id}")
         
-        for flask_id in self.flasks:
-            if self.flasks[flask_id]['assay_id'] == assay_id:
-                logger.info(f"  📭 Abrindo solenoide do frasco {flask_id} - EMERGÊNCIA")
-                self.flasks[flask_id]['solenoid_open'] = True
-                self.flasks[flask_id]['emergency_mode'] = True
+        idx = self._flasks_by_assay.get(assay_id, self._no_flasks)
+        for i in idx.tolist():
+            logger.info(f"  📭 Abrindo solenoide do frasco {i + 1} - EMERGÊNCIA")
+        self.flask_arr['solenoid_open'][idx] = True
+        self.flask_arr['emergency_mode'][idx] = True
         
         logger.error(f"⚠️ Todos os solenoides abertos - Pressão sendo purgada")
     
@@ -266,10 +431,10 @@ class ANKOMSimulator:
             logger.error(f"  🚨 ATENÇÃO: Pressão de alívio acima de 5 bar pode causar ruptura!")
         
         # Atualizar configuração de alívio para todos os frascos do ensaio
-        for flask_id in self.flasks:
-            if self.flasks[flask_id]['assay_id'] == assay_id:
-                self.flasks[flask_id]['relief_threshold'] = relief_pressure
-                self.flasks[flask_id]['warning_threshold'] = warning_threshold
+        idx = self._flasks_by_assay.get(assay_id, self._no_flasks)
+        self.flask_arr['relief_threshold'][idx] = relief_pressure
+        self.flask_arr['relief_pressure'][idx] = relief_pressure - 0.1
+        self.flask_arr['warning_threshold'][idx] = warning_threshold
     
     def handle_flask_initial_config(self, config):
         """
@@ -290,8 +455,7 @@ class ANKOMSimulator:
         # Cálculos PV=nRT
         headspace_volume = (total_volume - solution_volume) / 1000  # Convert ml to L
         temperature_kelvin = temperature + 273.15
-        R = 0.08314  # L·bar/mol·K
-        moles = (accumulated_pressure * headspace_volume) / (R * temperature_kelvin)
+        moles = (accumulated_pressure * headspace_volume) / (R_GAS * temperature_kelvin)
         
         logger.info(f"  📐 Volume do headspace: {headspace_volume:.3f} L")
         logger.info(f"  🌡️  Temperatura Kelvin: {temperature_kelvin:.2f} K")
@@ -303,6 +467,7 @@ class ANKOMSimulator:
             self.flasks[flask_id]['total_volume'] = total_volume
             self.flasks[flask_id]['solution_volume'] = solution_volume
             self.flasks[flask_id]['temperature'] = temperature
+            self.flask_arr['temperature'][flask_id - 1] = temperature
             self.flasks[flask_id]['headspace_volume'] = headspace_volume
             self.flasks[flask_id]['moles'] = moles
             self.flasks[flask_id]['temperature_kelvin'] = temperature_kelvin
@@ -314,175 +479,185 @@ class ANKOMSimulator:
         """
         return pressure * 273.15 / (temperature + 273.15)
     
-    def calculate_gas_production_rate(self, flask_id, current_pressure, time_elapsed):
+    def calculate_gas_production_rate(self, pressure, now):
         """
-        Calcular taxa de produção de gases (bar/h)
+        Calcular taxa de produção de gases (bar/h) de todos os frascos
+        pressure: pressões atuais (array); now: instante atual (time.monotonic())
         """
-        flask = self.flasks[flask_id]
+        arr = self.flask_arr
         
-        if not hasattr(flask, 'last_pressure'):
-            flask['last_pressure'] = current_pressure
-            flask['last_time'] = time_elapsed
-            return 0.0
+        time_diff = (now - arr['last_time_s']) * (1.0 / 3600.0)  # horas
+        pressure_diff = pressure - arr['last_pressure']
         
-        time_diff = (time_elapsed - flask['last_time']).total_seconds() / 3600  # horas
-        pressure_diff = current_pressure - flask['last_pressure']
-        
-        rate = pressure_diff / time_diff if time_diff > 0 else 0.0
+        # Sem leitura anterior (last_time_s = NaN) ou sem intervalo: taxa 0
+        rate = np.zeros_like(pressure)
+        np.divide(pressure_diff, time_diff, out=rate, where=time_diff > 0)
         
         # Atualizar últimos valores
-        flask['last_pressure'] = current_pressure
-        flask['last_time'] = time_elapsed
+        arr['last_pressure'][:] = pressure
+        arr['last_time_s'][:] = now
         
         return rate
     
-    def check_pressure_relief(self, flask_id, current_pressure):
+    def log_pressure_relief(self, flask_id, current_pressure, new_pressure):
         """
-        Verificar necessidade de alívio de pressão
+        Registrar alívio de pressão aplicado pelo kernel do ciclo
+        current_pressure: pressão medida (antes do alívio); new_pressure: pressão após o alívio
         """
-        threshold = self.config['relief_threshold']
-        
-        if current_pressure > threshold:
-            logger.warning(f"ALERTA: Pressão alta no frasco {flask_id}: {current_pressure:.2f} bar > {threshold} bar")
-            
-            # Simular alívio de pressão
-            self.flasks[flask_id]['relief_count'] += 1
-            self.flasks[flask_id]['last_relief'] = datetime.now()
-            
-            # Reduzir pressão para valor seguro
-            new_pressure = threshold - 0.1
-            logger.info(f"Alívio ativado no frasco {flask_id}. Pressão reduzida para {new_pressure:.2f} bar")
-            
-            return True, new_pressure
-        
-        return False, current_pressure
+        threshold = self.flask_arr['relief_threshold'][flask_id - 1]
+        logger.warning("ALERTA: Pressão alta no frasco %d: %.2f bar > %s bar", flask_id, current_pressure, threshold)
+        self.flasks[flask_id]['last_relief'] = datetime.now()
+        logger.info("Alívio ativado no frasco %d. Pressão reduzida para %.2f bar", flask_id, new_pressure)
     
-    def generate_telemetry_data(self, flask_id):
+    def generate_all_telemetry(self):
         """
-        Gerar dados de telemetria para um frasco
+        Gerar dados de telemetria de todos os frascos de uma vez (vetorizado)
         """
-        flask = self.flasks[flask_id]
+        arr = self.flask_arr
         
         # Tempo decorrido desde o início (horas)
-        time_elapsed = (datetime.now() - flask['start_time']).total_seconds() / 3600
+        now = time.monotonic()
+        time_elapsed = (now - arr['start_monotonic']) * (1.0 / 3600.0)
         
-        # Gerar pressão com modelo Gompertz + ruído
-        pressure = flask['model'].gompertz_with_noise(time_elapsed, noise_level=0.01)
+        # Gerar pressão com modelo Gompertz + ruído e variação de temperatura realista
+        noise = self.rng.standard_normal((2, self._pressure.size), dtype=np.float32)  # Ruído de pressão e de temperatura
+        # (o alívio de pressão também é aplicado no kernel)
+        tick_kernel(arr['A'], arr['B'], arr['C'], arr['baseline'], time_elapsed, noise[0], noise[1],
+                    arr['temperature'], arr['relief_threshold'], arr['relief_pressure'], arr['relief_count'],
+                    self._pressure, self._pressure_raw, self._temperature, self._relief, self.inv_Tk_norm)
+        pressure, temperature, relief = self._pressure, self._temperature, self._relief
         
-        # Adicionar variação de temperatura realista
-        temperature_variation = np.random.normal(0, 0.5)
-        temperature = max(38.0, min(40.0, flask['temperature'] + temperature_variation))
+        # Registrar os alívios (só os frascos em que ocorreram)
+        for i in np.nonzero(relief)[0].tolist():
+            self.log_pressure_relief(i + 1, self._pressure_raw[i], pressure[i])
         
-        # Verificar alívio de pressão
-        relief_triggered, pressure = self.check_pressure_relief(flask_id, pressure)
-        
-        # Normalização térmica
-        pressure_std = self.calculate_thermal_normalization(pressure, temperature)
+        # Normalização térmica (fator por frasco calculado no kernel)
+        pressure_std = pressure * self.inv_Tk_norm
         
         # Calcular taxa de produção
-        virtual_timestamp = flask['start_time'] + timedelta(hours=time_elapsed)
-        production_rate = self.calculate_gas_production_rate(flask_id, pressure, virtual_timestamp)
-        
-        # Criar payload MQTT
-        payload = {
-            "schema_version": 1,
-            "msg_id": str(uuid.uuid4()),
-            "assay_id": flask['assay_id'],
-            "flask_id": flask_id,
-            "ts": virtual_timestamp.isoformat() + "Z",
-            "P_bar_abs": round(pressure, 3),
-            "T_C": round(temperature, 1),
-            "P_bar_std": round(pressure_std, 3),
-            "accum_bar_per_h": round(production_rate, 4),
-            "relief_count": flask['relief_count'],
-            "time_elapsed_h": round(time_elapsed, 2)
-        }
-        
-        # Adicionar evento de alívio se necessário
-        if relief_triggered:
-            payload["event"] = "relief"
+        production_rate = self.calculate_gas_production_rate(pressure, now)
+        
+        # Timestamp único do ciclo, compartilhado por todos os frascos
+        ts_str = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace("+00:00", "Z")
+        
+        # Criar payloads MQTT
+        payloads = []
+        for t_h, p, T, p_std, rate, relief_count, relief_triggered in zip(
+                time_elapsed.tolist(), pressure.tolist(), temperature.tolist(),
+                pressure_std.tolist(), production_rate.tolist(), arr['relief_count'].tolist(),
+                relief.tolist()):
+            # Só os campos variáveis; schema_version, assay_id e flask_id vão no prefixo do frasco
+            payload = {
+                "msg_id": f"{self.session}-{next(self.msg_counter)}",
+                "ts": ts_str,
+                "P_bar_abs": round(p, 3),
+                "T_C": round(T, 1),
+                "P_bar_std": round(p_std, 3),
+                "accum_bar_per_h": round(rate, 4),
+                "relief_count": relief_count,
+                "time_elapsed_h": round(t_h, 2)
+            }
+            
+            # Adicionar evento de alívio se necessário
+            if relief_triggered:
+                payload["event"] = "relief"
+                
+            payloads.append(payload)
         
-        return payload
+        return payloads
     
-    def publish_telemetry(self, flask_id, data):
+    def publish_telemetry(self, payloads):
         """
-        Publicar dados de telemetria via MQTT
+        Publicar via MQTT os dados de telemetria de todos os frascos de um ciclo
+        (payloads na ordem de self.flasks, como retornados por generate_all_telemetry)
         """
-        topic = f"ankom/{data['assay_id']}/flask{flask_id}/telemetry"
-        
         try:
-            payload_json = json.dumps(data)
-            result = self.mqtt_client.publish(topic, payload_json, qos=1)
+            # Serializa o lote inteiro antes (prefixo fixo + campos variáveis sem o '{') e publica em sequência
+            flasks = self.flasks.values()
+            messages = [(flask['topic'], flask['payload_prefix'] + orjson.dumps(data)[1:])
+                        for flask, data in zip(flasks, payloads)]
+            results = [self.mqtt_client.publish(topic, payload_json, qos=1) for topic, payload_json in messages]
             
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"Dados publicados: Frasco {flask_id} - Pressão: {data['P_bar_abs']} bar, Temp: {data['T_C']}°C")
-            else:
-                logger.error(f"Falha ao publicar dados do frasco {flask_id}")
+            published = 0
+            for flask_id, result in zip(self.flasks, results):
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    published += 1
+                else:
+                    logger.error("Falha ao publicar dados do frasco %d", flask_id)
+            
+            # Log amostrado: só a cada N ciclos e só se INFO estiver habilitado
+            self._tick_counter += 1
+            if self._tick_counter % self._log_every == 0 and logger.isEnabledFor(logging.INFO):
+                logger.info("Dados publicados: %d/%d frascos", published, len(payloads))
                 
         except Exception as e:
             logger.error(f"Erro ao publicar MQTT: {e}")
     
-    def simulate_flask(self, flask_id):
+    def start_simulation(self):
+        """
+        Iniciar simulação de todos os frascos
+        """
+        logger.info("Iniciando simulação ANKOM RF")
+        self.running = True
+        
+        # Iniciar thread MQTT (a única thread auxiliar; a simulação roda em run_simulation)
+        self.mqtt_client.loop_start()
+        
+        logger.info(f"Simulação iniciada com {len(self.flasks)} frascos")
+    
+    def run_simulation(self, duration_hours):
         """
-        Thread de simulação para um frasco específico
+        Laço único de simulação, executado na thread chamadora: a cada intervalo
+        gera e publica todos os frascos em lote, até duration_hours ou stop_simulation()
         """
-        logger.info(f"Iniciando simulação do frasco {flask_id}")
+        end_time = time.monotonic() + duration_hours * 3600
+        next_tick = time.monotonic()  # Prazo do próximo ciclo (sem acumular deriva)
         
-        while self.running:
+        while self.running and time.monotonic() < end_time:
             try:
-                if self.paused:
-                    time.sleep(0.1)
+                self.run_scheduled(time.monotonic())
+                
+                if not self._run_event.is_set():
+                    # Pausado: bloquear até resume/stop, o fim da simulação ou a próxima ação agendada
+                    timeout = end_time - time.monotonic()
+                    if self._scheduled:
+                        timeout = min(timeout, self._scheduled[0][0] - time.monotonic())
+                    self._run_event.wait(timeout=max(0.0, timeout))
+                    next_tick = time.monotonic()
                     continue
 
                 # Avançar tempo virtual
-                self.flasks[flask_id]['sim_hours'] += (self.config['sampling_interval'] / 60.0)
+                self.flask_arr['sim_hours'] += self._sample_dt_h
 
-                telemetry_data = self.generate_telemetry_data(flask_id)
-                self.publish_telemetry(flask_id, telemetry_data)
+                self.publish_telemetry(self.generate_all_telemetry())
 
-                sleep_seconds = max(0.05, (self.config['sampling_interval'] * 60) / self.time_warp)
-                time.sleep(sleep_seconds)
+                # Próximo prazo = anterior + período; o tempo gasto no ciclo não se acumula
+                next_tick += max(0.05, self._sample_dt_s / self.time_warp)
+                now = time.monotonic()
+                sleep_seconds = next_tick - now
+                if sleep_seconds > 0:
+                    time.sleep(min(sleep_seconds, max(0.0, end_time - now)))
+                else:
+                    logger.warning("Atraso no ciclo (tick overrun): %.3fs", -sleep_seconds)
+                    next_tick = now
                 
             except Exception as e:
-                logger.error(f"Erro na simulação do frasco {flask_id}: {e}")
+                logger.error(f"Erro na simulação: {e}")
                 time.sleep(10)  # Esperar antes de tentar novamente
     
-    def start_simulation(self):
-        """
-        Iniciar simulação de todos os frascos
-        """
-        logger.info("Iniciando simulação ANKOM RF")
-        self.running = True
-        
-        # Iniciar thread MQTT
-        self.mqtt_client.loop_start()
-        
-        # Criar threads para cada frasco
-        for flask_id in self.flasks.keys():
-            thread = threading.Thread(target=self.simulate_flask, args=(flask_id,))
-            thread.daemon = True
-            thread.start()
-            self.threads.append(thread)
-            logger.info(f"Thread iniciada para frasco {flask_id}")
-        
-        logger.info(f"Simulação iniciada com {len(self.flasks)} frascos")
-    
     def stop_simulation(self):
         """
         Parar simulação
         """
         logger.info("Parando simulação ANKOM RF")
         self.running = False
+        self._run_event.set()  # Acordar o laço se estiver pausado
         
         # Parar MQTT
         if self.mqtt_client:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
         
-        # Aguardar threads terminarem
-        for thread in self.threads:
-            thread.join(timeout=5)
-        
         logger.info("Simulação finalizada")
 
 def main():
@@ -496,6 +671,7 @@ def main():
     parser.add_argument('--relief-threshold', type=float, default=1.5, help='Threshold de alívio (bar)')
     parser.add_argument('--mqtt-broker', default='localhost', help='Endereço do broker MQTT')
     parser.add_argument('--mqtt-port', type=int, default=1883, help='Porta MQTT')
+    parser.add_argument('--log-interval', type=int, default=1, help='Logar a publicação a cada N ciclos')
     
     args = parser.parse_args()
     
@@ -513,7 +689,8 @@ def main():
         'simulation_duration': args.duration,
         'relief_threshold': args.relief_threshold,
         'mqtt_broker': args.mqtt_broker,
-        'mqtt_port': args.mqtt_port
+        'mqtt_port': args.mqtt_port,
+        'log_interval': args.log_interval
     }
     
     logger.info(f"Configuração: {config}")
@@ -525,7 +702,7 @@ def main():
         
         # Rodar por tempo especificado
         logger.info(f"Simulação rodando por {args.duration} horas...")
-        time.sleep(args.duration * 3600)
+        simulator.run_simulation(args.duration)
         
         # Parar simulação
         simulator.stop_simulation()
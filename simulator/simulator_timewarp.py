@@ -1,11 +1,12 @@
 # Simulador ANKOM RF com Time Warp - Aceleração de Tempo
 # Baseado no modelo Gompertz com suporte a diferentes velocidades de simulação
 
-import json
+import orjson
 import time
 import random
 import uuid
-from datetime import datetime, timedelta
+import itertools
+from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
 import numpy as np
 from scipy.optimize import curve_fit
@@ -13,42 +14,96 @@ import threading
 import argparse
 import logging
 import signal
+import socket
 import sys
+import zlib
+
+# Numba é opcional: sem ele o ciclo usa o caminho NumPy vetorizado
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Conversão de segundos para horas
+SECONDS_TO_HOURS = 1.0 / 3600.0
+
+# Sufixo do tópico do lote comprimido: ankom/{assay_id}/batch/telemetry.zlib
+BATCH_TOPIC_SUFFIX = "batch/telemetry.zlib"
+
+def decode_telemetry_batch(payload):
+    """
+    Decodificar um lote publicado em BATCH_TOPIC_SUFFIX (lado do consumidor)
+    Retorna a lista de payloads dos frascos; levanta ValueError se o lote for inválido
+    """
+    try:
+        batch = orjson.loads(zlib.decompress(payload))
+    except (zlib.error, orjson.JSONDecodeError) as e:
+        raise ValueError(f"Lote de telemetria inválido: {e}") from e
+    if not isinstance(batch, dict) or not isinstance(batch.get('flasks'), list):
+        raise ValueError("Lote de telemetria sem lista 'flasks'")
+    return batch['flasks']
+
+# A partir desta velocidade, com --batch-zlib, o ciclo usa o caminho rápido (sem logs por ciclo)
+FAST_TICK_SPEED = 100
+
+# Colunas da matriz de estado mutável dos frascos (ANKOMTimeWarpSimulator.state)
+I_BASEP, I_LASTP, I_LASTT, I_TEMP, I_RELIEF = range(5)
+N_STATE_FIELDS = 5
+
 class TimeWarpSimulator:
     """
     Gerenciador de tempo com aceleração para simulação rápida
+    (internamente em segundos float: time.monotonic() real e época Unix simulada)
     """
     def __init__(self, speed_multiplier=1.0):
         self.speed_multiplier = speed_multiplier
-        self.start_real_time = datetime.now()
-        self.start_sim_time = datetime.now()
+        self.start_real_mono = time.monotonic()
+        self.start_sim_epoch = time.time()
         self.paused = False
-        self.pause_time = 0
+        self.pause_epoch = 0.0
         
-    def get_simulated_time(self):
+    def get_simulated_time_epoch(self):
         """
-        Obter tempo simulado baseado na aceleração
+        Obter tempo simulado (época Unix, em segundos) baseado na aceleração
         """
         if self.paused:
-            return self.pause_time
+            return self.pause_epoch
             
-        real_elapsed = (datetime.now() - self.start_real_time).total_seconds()
-        sim_elapsed = real_elapsed * self.speed_multiplier
-        return self.start_sim_time + timedelta(seconds=sim_elapsed)
+        real_elapsed = time.monotonic() - self.start_real_mono
+        return self.start_sim_epoch + real_elapsed * self.speed_multiplier
+    
+    def get_simulated_time(self):
+        """
+        Obter tempo simulado como datetime
+        """
+        return datetime.fromtimestamp(self.get_simulated_time_epoch())
+    
+    def get_simulated_iso(self, sim_epoch=None):
+        """
+        Formatar o tempo simulado em ISO-8601 UTC (só na publicação)
+        """
+        if sim_epoch is None:
+            sim_epoch = self.get_simulated_time_epoch()
+        return datetime.fromtimestamp(sim_epoch, timezone.utc).isoformat().replace("+00:00", "Z")
     
     def set_speed(self, speed_multiplier):
         """
         Alterar velocidade de simulação
         """
         # Recalcular tempos base para manter consistência
-        current_sim_time = self.get_simulated_time()
-        self.start_real_time = datetime.now()
-        self.start_sim_time = current_sim_time - timedelta(seconds=0)
+        current_sim_epoch = self.get_simulated_time_epoch()
+        self.start_real_mono = time.monotonic()
+        self.start_sim_epoch = current_sim_epoch
         self.speed_multiplier = speed_multiplier
         logger.info(f"Velocidade de simulação alterada para {speed_multiplier}x")
     
@@ -57,7 +112,7 @@ class TimeWarpSimulator:
         Pausar simulação
         """
         if not self.paused:
-            self.pause_time = self.get_simulated_time()
+            self.pause_epoch = self.get_simulated_time_epoch()
             self.paused = True
     
     def resume(self):
@@ -67,8 +122,8 @@ class TimeWarpSimulator:
         if self.paused:
             self.paused = False
             # Recalcular tempos base
-            self.start_real_time = datetime.now()
-            self.start_sim_time = self.pause_time
+            self.start_real_mono = time.monotonic()
+            self.start_sim_epoch = self.pause_epoch
 
 class GompertzModel:
     """
@@ -86,13 +141,55 @@ class GompertzModel:
         """
         return self.baseline + self.A * np.exp(-np.exp(self.B * (self.C - t)))
     
-    def gompertz_with_noise(self, t, noise_level=0.01):
-        """
-        Gompertz com ruído gaussiano controlado
-        """
-        pure_value = self.gompertz(t)
-        noise = np.random.normal(0, noise_level * pure_value)
-        return max(0.5, pure_value + noise)  # Limitar valor mínimo
+    @staticmethod
+    def evaluate_batch(A, B, C, baseline, exp_BC, t, out=None):
+        """
+        Gompertz vetorizado para vários frascos: exp(B * (C - t)) = exp(B*C) * exp(-B*t),
+        com exp_BC = exp(B*C) pré-calculado por frasco
+        out: buffer de saída opcional (sem arrays temporários)
+        """
+        if out is None:
+            return baseline + A * np.exp(-exp_BC * np.exp(-B * t))
+        np.multiply(B, t, out=out)
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        np.multiply(exp_BC, out, out=out)
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        np.multiply(A, out, out=out)
+        np.add(baseline, out, out=out)
+        return out
+
+# fastmath sem 'nnan': last_sim_epoch usa NaN para "sem leitura anterior"
+@njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+def _tick_kernel(A, B, exp_BC, baseline, t, z_p, z_T, temperature, last_P, last_epoch, sim_epoch,
+                 threshold, relief_count, out_p, out_T, out_std, out_rate, out_relief):
+    """
+    Kernel do ciclo para todos os frascos: Gompertz + ruído, limites, alívio,
+    normalização térmica e taxa de produção (atualiza relief_count, last_P e last_epoch)
+    """
+    for i in range(A.size):
+        # Gompertz: exp(B * (C - t)) = exp(B*C) * exp(-B*t)
+        p = baseline[i] + A[i] * np.exp(-exp_BC[i] * np.exp(-B[i] * t[i]))
+        # Limites e alívio sem desvios: min/max e seleção compilam para cmov
+        p = max(0.5, p + z_p[i] * 0.01 * p)
+        T = min(40.0, max(38.0, temperature[i] + z_T[i] * 0.5))
+        
+        # Alívio de pressão
+        relief = p > threshold
+        p = threshold - 0.1 if relief else p
+        relief_count[i] += relief
+        
+        # Taxa de produção (bar/h); sem leitura anterior ou sem intervalo: 0
+        dt_h = (sim_epoch - last_epoch[i]) * (1.0 / 3600.0)
+        out_rate[i] = (p - last_P[i]) / dt_h if dt_h > 0 else 0.0
+        last_P[i] = p
+        last_epoch[i] = sim_epoch
+        
+        out_p[i] = p
+        out_T[i] = T
+        out_std[i] = p * 273.15 / (T + 273.15)
+        out_relief[i] = relief
 
 class ANKOMTimeWarpSimulator:
     """
@@ -103,9 +200,21 @@ class ANKOMTimeWarpSimulator:
         self.flasks = {}
         self.mqtt_client = None
         self.running = False
-        self.threads = []
+        self._loop_thread = None
         self.time_warp = TimeWarpSimulator(config.get('speed_multiplier', 1.0))
         
+        # msg_id = "<sessão>-<frasco>-<seq>": todos os frascos publicam uma vez por ciclo,
+        # então o contador de ciclos serve de sequência por frasco.
+        # --strict-uuid mantém um UUID4 (RFC 4122) por mensagem.
+        self.session_id = uuid.uuid4().hex[:8]
+        self.strict_uuid = config.get('strict_uuid', False)
+        self.tick_seq = itertools.count()
+        
+        # Lote único comprimido por ensaio em vez de uma mensagem por frasco (--batch-zlib)
+        self.batch_zlib = config.get('batch_zlib', False)
+        self.rng = np.random.default_rng()  # Gerador de ruído (PCG64)
+        self._tick_fn = self._slow_tick  # Trocado por _fast_tick em velocidades altas
+        
         # Inicializar frascos
         self.initialize_flasks()
         
@@ -135,25 +244,95 @@ class ANKOMTimeWarpSimulator:
                 'assay_id': assay_id,
                 'model': GompertzModel(**gompertz_params),
                 'start_time': datetime.now(),
-                'last_relief': datetime.now(),
-                'relief_count': 0,
                 'temperature': 39.0,  # Temperatura base 39°C
                 'baseline_pressure': 1.0,  # Pressão inicial 1.0 bar
-                'last_pressure': 1.0,
-                'last_time': 0
+                # Tópico e payload cacheados: o template é atualizado no lugar a cada ciclo
+                'topic': f"ankom/{assay_id}/flask{flask_id}/telemetry",
+                'msg_prefix': f"{self.session_id}-{flask_id}-",
+                'template': {"schema_version": 1, "assay_id": assay_id, "flask_id": flask_id}
             }
             
             logger.info(f"Frasco {flask_id} inicializado: A={gompertz_params['A']}, B={gompertz_params['B']}, C={gompertz_params['C']}")
+        
+        # Linhas de cada ensaio, para o lote do caminho rápido
+        self._assay_rows = {}
+        for row, flask in enumerate(self.flasks.values()):
+            self._assay_rows.setdefault(flask['assay_id'], []).append(row)
+        
+        # Estado mutável dos frascos numa matriz (linha = flask_id - 1, colunas I_*);
+        # ordem de colunas (Fortran): cada campo é um vetor contíguo para o kernel
+        flasks = list(self.flasks.values())
+        self.state = np.zeros((len(flasks), N_STATE_FIELDS), order='F')
+        self.state[:, I_BASEP] = [f['model'].baseline for f in flasks]
+        self.state[:, I_LASTP] = self.state[:, I_BASEP]
+        self.state[:, I_LASTT] = np.nan  # Sem leitura anterior
+        self.state[:, I_TEMP] = [f['temperature'] for f in flasks]
+        
+        # Parâmetros constantes em Struct-of-Arrays; o estado mutável entra como visões das colunas
+        self.flask_arr = {
+            'A': np.array([f['model'].A for f in flasks]),
+            'B': np.array([f['model'].B for f in flasks]),
+            'C': np.array([f['model'].C for f in flasks]),
+            'start_time_s': np.array([f['start_time'].timestamp() for f in flasks]),
+            'baseline': self.state[:, I_BASEP],
+            'temperature': self.state[:, I_TEMP],
+            'relief_count': self.state[:, I_RELIEF],
+            'last_pressure': self.state[:, I_LASTP],
+            'last_sim_epoch': self.state[:, I_LASTT]
+        }
+        self.flask_arr['exp_BC'] = np.exp(self.flask_arr['B'] * self.flask_arr['C'])  # Constante por frasco
+        
+        # Buffers do ciclo, pré-alocados e reutilizados (kernel e caminho NumPy via out=);
+        # o número de frascos é fixo durante a simulação
+        n = len(flasks)
+        self._t = np.empty(n)
+        self._pure = np.empty(n)
+        self._z = np.empty(2 * n)
+        self._pressure = np.empty(n)
+        self._temperature = np.empty(n)
+        self._pressure_std = np.empty(n)
+        self._rate = np.empty(n)
+        self._relief = np.empty(n, dtype=np.bool_)
+        self._scratch = np.empty(n)
+        self._mask = np.empty(n, dtype=np.bool_)
+        
+        if HAVE_NUMBA:
+            self._warmup_kernel()
+    
+    def _warmup_kernel(self):
+        """
+        Compilar o kernel na inicialização, fora do laço de simulação, com colunas de uma
+        cópia do estado (mesmo layout da chamada real, sem alterar o estado)
+        """
+        arr = self.flask_arr
+        state = self.state.copy(order='F')
+        zeros = np.zeros(self._pressure.size)
+        _tick_kernel(arr['A'], arr['B'], arr['exp_BC'], state[:, I_BASEP], zeros, zeros, zeros,
+                     state[:, I_TEMP], state[:, I_LASTP], state[:, I_LASTT], 0.0,
+                     self.config['relief_threshold'], state[:, I_RELIEF],
+                     self._pressure, self._temperature, self._pressure_std, self._rate, self._relief)
     
     def setup_mqtt(self):
         """
         Configurar cliente MQTT
         """
-        self.mqtt_client = mqtt.Client()
+        try:
+            # API de callbacks v2 (paho-mqtt >= 2.0): sem a camada de adaptação da v1
+            self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            self.mqtt_client.on_disconnect = self.on_disconnect
+        except AttributeError:
+            # paho-mqtt < 2.0: só existe a API v1, adaptar a assinatura do on_disconnect
+            self.mqtt_client = mqtt.Client()
+            self.mqtt_client.on_disconnect = lambda client, userdata, rc: self.on_disconnect(
+                client, userdata, None, rc, None)
         self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_message = self.on_message
         
+        # Janela de QoS 1 larga (só eventos de alívio usam QoS 1) e fila sem limite;
+        # precisa ser configurado antes de conectar
+        self.mqtt_client.max_inflight_messages_set(1000)
+        self.mqtt_client.max_queued_messages_set(0)
+        
         try:
             self.mqtt_client.connect(self.config['mqtt_broker'], self.config['mqtt_port'], 60)
             logger.info(f"Conectado ao MQTT broker: {self.config['mqtt_broker']}:{self.config['mqtt_port']}")
@@ -161,26 +340,30 @@ class ANKOMTimeWarpSimulator:
             logger.error(f"Erro ao conectar ao MQTT: {e}")
             raise
     
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
         """
-        Callback de conexão MQTT
+        Callback de conexão MQTT (API v2; na v1 properties não é passado)
         """
-        if rc == 0:
+        if reason_code == 0:
             logger.info("Conectado ao broker MQTT com sucesso")
+            # Desativar Nagle: o lote de publicações do ciclo sai imediatamente
+            sock = client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             # Inscrever em tópicos de configuração
             client.subscribe("ankom/config/+/set")
             client.subscribe("ankom/control/speed")
             client.subscribe("ankom/control/pause")
             client.subscribe("ankom/control/resume")
         else:
-            logger.error(f"Falha na conexão MQTT. Código: {rc}")
+            logger.error(f"Falha na conexão MQTT. Código: {reason_code}")
     
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         """
-        Callback de desconexão MQTT
+        Callback de desconexão MQTT (API v2)
         """
         logger.warning("Desconectado do broker MQTT")
-        if rc != 0:
+        if reason_code != 0:
             logger.error("Desconexão inesperada. Tentando reconectar...")
     
     def on_message(self, client, userdata, message):
@@ -188,14 +371,16 @@ class ANKOMTimeWarpSimulator:
         Callback de mensagem MQTT
         """
         try:
-            payload = json.loads(message.payload.decode())
+            payload = orjson.loads(message.payload)
             topic = message.topic
             
-            logger.info(f"Mensagem recebida no tópico {topic}: {payload}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Mensagem recebida no tópico %s: %s", topic, payload)
             
             if topic == "ankom/control/speed":
                 speed = payload.get('speed', 1.0)
                 self.time_warp.set_speed(speed)
+                self._select_tick_fn()
             elif topic == "ankom/control/pause":
                 self.time_warp.pause()
             elif topic == "ankom/control/resume":
@@ -204,141 +389,287 @@ class ANKOMTimeWarpSimulator:
         except Exception as e:
             logger.error(f"Erro ao processar mensagem MQTT: {e}")
     
-    def calculate_thermal_normalization(self, pressure, temperature):
+    def calculate_thermal_normalization(self, pressure, temperature, out=None):
         """
         Normalização térmica pela lei dos gases ideais
-        """
-        return pressure * 273.15 / (temperature + 273.15)
+        out: buffer de saída opcional
+        """
+        if out is None:
+            return pressure * 273.15 / (temperature + 273.15)
+        np.add(temperature, 273.15, out=out)
+        np.divide(pressure, out, out=out)
+        np.multiply(out, 273.15, out=out)
+        return out
     
-    def calculate_gas_production_rate(self, flask_id, current_pressure, sim_time):
+    def calculate_gas_production_rate(self, pressure, sim_epoch):
         """
-        Calcular taxa de produção de gases (bar/h)
+        Calcular taxa de produção de gases (bar/h) de todos os frascos
+        pressure: pressões atuais (array); sim_epoch: tempo simulado em segundos (época Unix)
         """
-        flask = self.flasks[flask_id]
+        arr = self.flask_arr
         
-        if 'last_pressure' not in flask or 'last_sim_time' not in flask:
-            flask['last_pressure'] = current_pressure
-            flask['last_sim_time'] = sim_time
-            return 0.0
+        time_diff = np.subtract(sim_epoch, arr['last_sim_epoch'], out=self._scratch)
+        time_diff *= SECONDS_TO_HOURS  # horas
+        rate = np.subtract(pressure, arr['last_pressure'], out=self._rate)
         
-        time_diff = (sim_time - flask['last_sim_time']).total_seconds() / 3600  # horas
-        pressure_diff = current_pressure - flask['last_pressure']
-        
-        rate = pressure_diff / time_diff if time_diff > 0 else 0.0
+        # Sem leitura anterior (last_sim_epoch = NaN) ou sem intervalo: taxa 0
+        valid = np.greater(time_diff, 0, out=self._mask)
+        np.divide(rate, time_diff, out=rate, where=valid)
+        rate *= valid
         
         # Atualizar últimos valores
-        flask['last_pressure'] = current_pressure
-        flask['last_sim_time'] = sim_time
+        arr['last_pressure'][:] = pressure
+        arr['last_sim_epoch'][:] = sim_epoch
         
         return rate
     
-    def check_pressure_relief(self, flask_id, current_pressure):
+    def apply_pressure_relief(self, pressure):
         """
-        Verificar necessidade de alívio de pressão
+        Aplicar alívio de pressão a todos os frascos (vetorizado)
+        Reduz no lugar as pressões acima do limite e retorna a máscara dos frascos aliviados
         """
         threshold = self.config['relief_threshold']
-        
-        if current_pressure > threshold:
-            logger.warning(f"ALERTA: Pressão alta no frasco {flask_id}: {current_pressure:.2f} bar > {threshold} bar")
-            
-            # Simular alívio de pressão
-            self.flasks[flask_id]['relief_count'] += 1
-            self.flasks[flask_id]['last_relief'] = datetime.now()
-            
-            # Reduzir pressão para valor seguro
-            new_pressure = threshold - 0.1
-            logger.info(f"Alívio ativado no frasco {flask_id}. Pressão reduzida para {new_pressure:.2f} bar")
-            
-            return True, new_pressure
-        
-        return False, current_pressure
+        relief = np.greater(pressure, threshold, out=self._relief)
+        np.copyto(pressure, threshold - 0.1, where=relief)  # Reduzir pressão para valor seguro
+        self.flask_arr['relief_count'] += relief
+        return relief
     
-    def generate_telemetry_data(self, flask_id):
+    def log_pressure_relief(self, relief):
         """
-        Gerar dados de telemetria para um frasco
+        Registrar numa única linha os alívios de pressão do ciclo
         """
-        flask = self.flasks[flask_id]
-        
-        # Obter tempo simulado
-        sim_time = self.time_warp.get_simulated_time()
+        if relief.any():
+            logger.warning("Alívio de pressão nos frascos %s: acima de %s bar, reduzida para %.2f bar",
+                           (np.flatnonzero(relief) + 1).tolist(), self.config['relief_threshold'],
+                           self.config['relief_threshold'] - 0.1)
+    
+    def _compute_tick(self, sim_epoch):
+        """
+        Parte numérica do ciclo para todos os frascos no instante simulado sim_epoch
+        Retorna (time_elapsed, pressure, temperature, pressure_std, production_rate, relief)
+        """
+        arr = self.flask_arr
         
         # Tempo decorrido desde o início (horas)
-        time_elapsed = (sim_time - flask['start_time']).total_seconds() / 3600
-        
-        # Gerar pressão com modelo Gompertz + ruído
-        pressure = flask['model'].gompertz_with_noise(time_elapsed, noise_level=0.01)
-        
-        # Adicionar variação de temperatura realista
-        temperature_variation = np.random.normal(0, 0.5)
-        temperature = max(38.0, min(40.0, flask['temperature'] + temperature_variation))
-        
-        # Verificar alívio de pressão
-        relief_triggered, pressure = self.check_pressure_relief(flask_id, pressure)
-        
-        # Normalização térmica
-        pressure_std = self.calculate_thermal_normalization(pressure, temperature)
-        
-        # Calcular taxa de produção
-        production_rate = self.calculate_gas_production_rate(flask_id, pressure, sim_time)
-        
-        # Criar payload MQTT
-        payload = {
-            "schema_version": 1,
-            "msg_id": str(uuid.uuid4()),
-            "assay_id": flask['assay_id'],
-            "flask_id": flask_id,
-            "ts": sim_time.isoformat() + "Z",
-            "P_bar_abs": round(pressure, 3),
-            "T_C": round(temperature, 1),
-            "P_bar_std": round(pressure_std, 3),
-            "accum_bar_per_h": round(production_rate, 4),
-            "relief_count": flask['relief_count'],
-            "time_elapsed_h": round(time_elapsed, 2),
-            "speed_multiplier": self.time_warp.speed_multiplier
-        }
+        time_elapsed = np.subtract(sim_epoch, arr['start_time_s'], out=self._t)
+        time_elapsed *= SECONDS_TO_HOURS
+        
+        # Ruído gaussiano de pressão e de temperatura, gerado numa única chamada
+        n = time_elapsed.size
+        z = self.rng.standard_normal(out=self._z)
+        
+        if HAVE_NUMBA:
+            # Kernel compilado: todo o ciclo numérico num único laço
+            _tick_kernel(arr['A'], arr['B'], arr['exp_BC'], arr['baseline'], time_elapsed, z[:n], z[n:],
+                         arr['temperature'], arr['last_pressure'], arr['last_sim_epoch'], sim_epoch,
+                         self.config['relief_threshold'], arr['relief_count'],
+                         self._pressure, self._temperature, self._pressure_std, self._rate, self._relief)
+            pressure, temperature, relief = self._pressure, self._temperature, self._relief
+            pressure_std, production_rate = self._pressure_std, self._rate
+            
+        else:
+            # Gerar pressão com modelo Gompertz + ruído
+            pure = GompertzModel.evaluate_batch(arr['A'], arr['B'], arr['C'], arr['baseline'],
+                                                arr['exp_BC'], time_elapsed, out=self._pure)
+            pressure = np.multiply(z[:n], 0.01, out=self._pressure)
+            pressure *= pure
+            pressure += pure
+            np.clip(pressure, 0.5, None, out=pressure)  # Limitar valor mínimo
+            
+            # Adicionar variação de temperatura realista
+            temperature = np.multiply(z[n:], 0.5, out=self._temperature)
+            temperature += arr['temperature']
+            np.clip(temperature, 38.0, 40.0, out=temperature)
+            
+            # Verificar alívio de pressão
+            relief = self.apply_pressure_relief(pressure)
+            
+            # Normalização térmica
+            pressure_std = self.calculate_thermal_normalization(pressure, temperature, out=self._pressure_std)
+            
+            # Calcular taxa de produção
+            production_rate = self.calculate_gas_production_rate(pressure, sim_epoch)
         
-        # Adicionar evento de alívio se necessário
-        if relief_triggered:
-            payload["event"] = "relief"
+        return time_elapsed, pressure, temperature, pressure_std, production_rate, relief
+    
+    def generate_all_telemetry(self, sim_epoch=None):
+        """
+        Gerar dados de telemetria de todos os frascos de uma vez (vetorizado)
+        sim_epoch: tempo simulado do ciclo (segundos); se omitido, lido do time warp
+        Retorna lista de (flask_id, payload); os payloads são os templates dos
+        frascos, reutilizados no próximo ciclo
+        """
+        arr = self.flask_arr
+        
+        # Tempo simulado do ciclo (segundos), compartilhado por todos os frascos;
+        # o timestamp é formatado uma única vez
+        if sim_epoch is None:
+            sim_epoch = self.time_warp.get_simulated_time_epoch()
+        ts = self.time_warp.get_simulated_iso(sim_epoch)
+        
+        time_elapsed, pressure, temperature, pressure_std, production_rate, relief = \
+            self._compute_tick(sim_epoch)
+        
+        # Registrar os alívios do ciclo (no máximo uma linha)
+        self.log_pressure_relief(relief)
+        
+        # Criar payloads MQTT
+        seq = next(self.tick_seq)
+        batch = []
+        for flask_id, t_h, p, T, p_std, rate, relief_count, relief_triggered in zip(
+                self.flasks, time_elapsed.tolist(), pressure.tolist(), temperature.tolist(),
+                pressure_std.tolist(), production_rate.tolist(), arr['relief_count'].astype(int).tolist(),
+                relief.tolist()):
+            # Atualizar no lugar o template do frasco (campos fixos já preenchidos)
+            payload = self.flasks[flask_id]['template']
+            payload["msg_id"] = str(uuid.uuid4()) if self.strict_uuid else f"{self.flasks[flask_id]['msg_prefix']}{seq}"
+            payload["ts"] = ts
+            payload["P_bar_abs"] = round(p, 3)
+            payload["T_C"] = round(T, 1)
+            payload["P_bar_std"] = round(p_std, 3)
+            payload["accum_bar_per_h"] = round(rate, 4)
+            payload["relief_count"] = relief_count
+            payload["time_elapsed_h"] = round(t_h, 2)
+            payload["speed_multiplier"] = self.time_warp.speed_multiplier
+            
+            # Adicionar evento de alívio se necessário
+            if relief_triggered:
+                payload["event"] = "relief"
+            else:
+                payload.pop("event", None)
+            
+            batch.append((flask_id, payload))
         
-        return payload
+        return batch
     
     def publish_telemetry(self, flask_id, data):
         """
         Publicar dados de telemetria via MQTT
+        (QoS 0 para telemetria de rotina, QoS 1 só para eventos de alívio)
         """
-        topic = f"ankom/{data['assay_id']}/flask{flask_id}/telemetry"
+        topic = self.flasks[flask_id]['topic']
         
         try:
-            payload_json = json.dumps(data)
-            result = self.mqtt_client.publish(topic, payload_json, qos=1)
+            payload_json = orjson.dumps(data)
+            qos = 1 if 'event' in data else 0
+            result = self.mqtt_client.publish(topic, payload_json, qos=qos)
             
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"Dados publicados: Frasco {flask_id} - Pressão: {data['P_bar_abs']} bar, Temp: {data['T_C']}°C, Speed: {data['speed_multiplier']}x")
-            else:
-                logger.error(f"Falha ao publicar dados do frasco {flask_id}")
+            # Telemetria de rotina só em DEBUG; INFO fica para eventos (alívio, reconfiguração)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error("Falha ao publicar dados do frasco %d", flask_id)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Dados publicados: Frasco %d - Pressão: %s bar, Temp: %s°C, Speed: %sx",
+                             flask_id, data['P_bar_abs'], data['T_C'], data['speed_multiplier'])
                 
         except Exception as e:
             logger.error(f"Erro ao publicar MQTT: {e}")
     
-    def simulate_flask(self, flask_id):
+    def publish_all(self, batch):
         """
-        Thread de simulação para um frasco específico
+        Publicar em sequência a telemetria de todos os frascos de um ciclo
+        (ou um lote comprimido por ensaio, com --batch-zlib)
         """
-        logger.info(f"Iniciando simulação do frasco {flask_id}")
+        if self.batch_zlib:
+            self.publish_batch(batch)
+            return
+        
+        for flask_id, telemetry_data in batch:
+            self.publish_telemetry(flask_id, telemetry_data)
+    
+    def publish_batch(self, batch):
+        """
+        Publicar a telemetria do ciclo como uma mensagem por ensaio, JSON comprimido com zlib
+        em ankom/{assay_id}/batch/telemetry.zlib (decodificar com decode_telemetry_batch)
+        """
+        by_assay = {}
+        for _, data in batch:
+            by_assay.setdefault(data['assay_id'], []).append(data)
+        
+        try:
+            for assay_id, flasks in by_assay.items():
+                # level=1: melhor relação compressão/CPU para payloads pequenos e repetitivos
+                payload = zlib.compress(orjson.dumps({"ts": flasks[0]['ts'], "flasks": flasks}), 1)
+                qos = 1 if any('event' in data for data in flasks) else 0
+                result = self.mqtt_client.publish(f"ankom/{assay_id}/{BATCH_TOPIC_SUFFIX}", payload, qos=qos)
+                
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logger.error("Falha ao publicar lote do ensaio %s", assay_id)
+                elif logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Lote publicado: ensaio %s - %d frascos, %d bytes", assay_id, len(flasks), len(payload))
+                    
+        except Exception as e:
+            logger.error(f"Erro ao publicar MQTT: {e}")
+    
+    def _slow_tick(self, sim_epoch):
+        """
+        Ciclo completo: payload por frasco, log de alívio e publicação conforme as opções
+        """
+        self.publish_all(self.generate_all_telemetry(sim_epoch))
+    
+    def _fast_tick(self, sim_epoch):
+        """
+        Ciclo enxuto para replays rápidos com --batch-zlib (velocidade >= FAST_TICK_SPEED):
+        mesmo lote por ensaio de publish_batch (QoS 1 se houver alívio, msg_id conforme
+        --strict-uuid), sem logs de alívio nem de publicação
+        """
+        arr = self.flask_arr
+        ts = self.time_warp.get_simulated_iso(sim_epoch)
+        time_elapsed, pressure, temperature, pressure_std, production_rate, relief = \
+            self._compute_tick(sim_epoch)
+        seq = next(self.tick_seq)
+        speed = self.time_warp.speed_multiplier
+        
+        # Arredondamento vetorizado; a conversão para Python acontece uma vez por coluna
+        rows = []
+        for flask, t_h, p, T, p_std, rate, relief_count, relief_triggered in zip(
+                self.flasks.values(), np.round(time_elapsed, 2).tolist(), np.round(pressure, 3).tolist(),
+                np.round(temperature, 1).tolist(), np.round(pressure_std, 3).tolist(),
+                np.round(production_rate, 4).tolist(), arr['relief_count'].astype(int).tolist(),
+                relief.tolist()):
+            msg_id = str(uuid.uuid4()) if self.strict_uuid else f"{flask['msg_prefix']}{seq}"
+            row = {**flask['template'], "msg_id": msg_id, "ts": ts,
+                   "P_bar_abs": p, "T_C": T, "P_bar_std": p_std, "accum_bar_per_h": rate,
+                   "relief_count": relief_count, "time_elapsed_h": t_h, "speed_multiplier": speed}
+            if relief_triggered:
+                row["event"] = "relief"
+            rows.append(row)
+        
+        for assay_id, idx in self._assay_rows.items():
+            flasks = [rows[i] for i in idx]
+            payload = zlib.compress(orjson.dumps({"ts": ts, "flasks": flasks}), 1)
+            qos = 1 if any('event' in row for row in flasks) else 0
+            result = self.mqtt_client.publish(f"ankom/{assay_id}/{BATCH_TOPIC_SUFFIX}", payload, qos=qos)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error("Falha ao publicar lote do ensaio %s", assay_id)
+    
+    def _select_tick_fn(self):
+        """
+        Escolher o ciclo conforme a velocidade: caminho enxuto em replays rápidos com
+        --batch-zlib, caminho completo (com logs) no uso interativo; sem --batch-zlib a
+        telemetria continua saindo por frasco em ankom/{assay_id}/flaskN/telemetry
+        """
+        fast = self.batch_zlib and self.time_warp.speed_multiplier >= FAST_TICK_SPEED
+        self._tick_fn = self._fast_tick if fast else self._slow_tick
+    
+    def _run_tick_loop(self):
+        """
+        Laço único de simulação: a cada ciclo gera a telemetria de todos os
+        frascos e publica em lote, com prazos em time.monotonic() (sem deriva)
+        """
+        logger.info(f"Iniciando simulação de {len(self.flasks)} frascos")
+        next_tick_mono = time.monotonic()
         
         while self.running:
             try:
                 # Verificar se está pausado
                 if self.time_warp.paused:
-                    time.sleep(0.1)
+                    time.sleep(0.05)
+                    next_tick_mono = time.monotonic()
                     continue
                 
-                # Gerar dados de telemetria
-                telemetry_data = self.generate_telemetry_data(flask_id)
-                
-                # Publicar via MQTT
-                self.publish_telemetry(flask_id, telemetry_data)
+                # Gerar dados de telemetria de todos os frascos (um único instante simulado) e publicar
+                sim_epoch = self.time_warp.get_simulated_time_epoch()
+                self._tick_fn(sim_epoch)
                 
                 # Calcular intervalo de espera baseado na velocidade
                 base_interval = self.config['sampling_interval'] * 60  # segundos
@@ -347,11 +678,18 @@ class ANKOMTimeWarpSimulator:
                 # Limitar intervalo mínimo para não sobrecarregar o sistema
                 actual_interval = max(0.1, adjusted_interval)
                 
-                time.sleep(actual_interval)
+                # Próximo prazo = anterior + intervalo; o tempo gasto no ciclo não se acumula
+                next_tick_mono += actual_interval
+                now = time.monotonic()
+                if next_tick_mono > now:
+                    time.sleep(next_tick_mono - now)
+                else:
+                    next_tick_mono = now  # Ciclo atrasado: não tentar recuperar em rajada
                 
             except Exception as e:
-                logger.error(f"Erro na simulação do frasco {flask_id}: {e}")
+                logger.error(f"Erro na simulação: {e}")
                 time.sleep(1)  # Esperar antes de tentar novamente
+                next_tick_mono = time.monotonic()
     
     def start_simulation(self):
         """
@@ -363,13 +701,12 @@ class ANKOMTimeWarpSimulator:
         # Iniciar thread MQTT
         self.mqtt_client.loop_start()
         
-        # Criar threads para cada frasco
-        for flask_id in self.flasks.keys():
-            thread = threading.Thread(target=self.simulate_flask, args=(flask_id,))
-            thread.daemon = True
-            thread.start()
-            self.threads.append(thread)
-            logger.info(f"Thread iniciada para frasco {flask_id}")
+        self._select_tick_fn()
+        
+        # Uma única thread de simulação para todos os frascos
+        self._loop_thread = threading.Thread(target=self._run_tick_loop)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
         
         logger.info(f"Simulação iniciada com {len(self.flasks)} frascos, velocidade: {self.time_warp.speed_multiplier}x")
     
@@ -385,9 +722,9 @@ class ANKOMTimeWarpSimulator:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
         
-        # Aguardar threads terminarem
-        for thread in self.threads:
-            thread.join(timeout=5)
+        # Aguardar a thread de simulação terminar
+        if self._loop_thread:
+            self._loop_thread.join(timeout=5)
         
         logger.info("Simulação finalizada")
 
@@ -412,6 +749,9 @@ def main():
     parser.add_argument('--relief-threshold', type=float, default=1.5, help='Threshold de alívio (bar)')
     parser.add_argument('--mqtt-broker', default='localhost', help='Endereço do broker MQTT')
     parser.add_argument('--mqtt-port', type=int, default=1883, help='Porta MQTT')
+    parser.add_argument('--strict-uuid', action='store_true', help='Usar UUID4 como msg_id de cada mensagem')
+    parser.add_argument('--batch-zlib', action='store_true',
+                        help='Publicar um lote comprimido (zlib) por ensaio em vez de uma mensagem por frasco')
     
     args = parser.parse_args()
     
@@ -433,7 +773,9 @@ def main():
         'speed_multiplier': args.speed,
         'relief_threshold': args.relief_threshold,
         'mqtt_broker': args.mqtt_broker,
-        'mqtt_port': args.mqtt_port
+        'mqtt_port': args.mqtt_port,
+        'strict_uuid': args.strict_uuid,
+        'batch_zlib': args.batch_zlib
     }
     
     logger.info(f"Configuração: {config}")